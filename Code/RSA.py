@@ -1,5 +1,6 @@
 import random
 import math
+import numpy as np
 
 def inverse(a, m):  # Gives the modular inverse of a modulo m
     for b in range(1, m):
@@ -7,7 +8,9 @@ def inverse(a, m):  # Gives the modular inverse of a modulo m
             return b
     return -1
 
-def keys(key_size):
+def keys(key_size, rng=None):
+    # rng = random number generator (numpy Generator). If not specified, one is seeded from the random module
+    rng = rng if rng is not None else np.random.default_rng(random.getrandbits(64))
     min = 2 ** (key_size - 1)
     max = (2 ** key_size) - 1
     primes = [2]
@@ -24,16 +27,16 @@ def keys(key_size):
     while primes and primes[0] < start:  # Getting rid of the prime numbers in the list that aren't large enough
         del primes[0]
     while primes:
-        p = random.choice(primes)
+        p = primes[rng.integers(len(primes))]
         primes.remove(p)
         q_values = [q for q in primes if min <= p * q <= max]
         if q_values:
-            q = random.choice(q_values)
+            q = q_values[rng.integers(len(q_values))]
             break
     n = p * q
     s = (p - 1) * (q - 1)
     while True:
-        e = random.randrange(1, s)
+        e = int(rng.integers(1, s))
         g = math.gcd(e, s)
         d = inverse(e, s)
         if g == 1 and e != d:
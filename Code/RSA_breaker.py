@@ -1,8 +1,9 @@
 import shor, RSA
 import math,time
+import functools
+import sweep, results_store, result_cache, pipeline
 import numpy as np
 import matplotlib.pyplot as plt
-import os
 import pickle
 
 # write list to binary file
@@ -27,13 +28,13 @@ def get_private_key(factors,public_key):
 	d = RSA.inverse(e, s)
 	return (d,n)
 
-def factorise_modulus(public_key,bits,verbose=None):
+def factorise_modulus(public_key,bits,verbose=None,errorp=None,error_size=None,rng=None):
 	verbose = verbose if verbose != None else False
 	e,n = public_key
 	main_register_bitnumber = bits if bits!= None else 5
 	if verbose: print("Working...")
-	J=shor.shor(n,bits=main_register_bitnumber,verbose=verbose)
-	output = J.run_algorithm()
+	J=shor.shor(n,bits=main_register_bitnumber,verbose=verbose,rng=rng)
+	output = J.run_algorithm(errorp=errorp,error_size=error_size,rng=rng)
 	if output[1]:   # Check if the algorithm was skipped
 		factors=output[0]
 		#break
@@ -47,15 +48,15 @@ def factorise_modulus(public_key,bits,verbose=None):
 		# 	break
 	return factors
 
-def crack_key(keys=None,verbose=None,bits=None):
+def crack_key(keys=None,verbose=None,bits=None,errorp=None,error_size=None,rng=None):
 	verbose = verbose if verbose != None else False
 	working_bits = bits if bits != None else 5
 	# Get 3 bit RSA keys
-	public, private = keys if keys!= None else RSA.keys(2**3)
+	public, private = keys if keys!= None else RSA.keys(2**3,rng=rng)
 	if verbose: print("Public Key:",public)
 	if verbose: print("Private Key:",private)
 	# Find non-trivial prime factors of the modulus
-	result = factorise_modulus(public,working_bits,verbose=verbose)
+	result = factorise_modulus(public,working_bits,verbose=verbose,errorp=errorp,error_size=error_size,rng=rng)
 	#print(result,result[0]*result[1])
 	# Compute private key
 	cracked = get_private_key(result,public)
@@ -68,35 +69,81 @@ def crack_key(keys=None,verbose=None,bits=None):
 		success = False
 	return success
 
-def main():
+def crack_shot(keys=None,bits=None,errorp=None,error_size=None,rng=None):
+	"""
+	Runs one attempt at cracking an RSA key for a sweep, counting any exception as a failure.
+	"""
+	try:
+		return crack_key(keys=keys,bits=bits,errorp=errorp,error_size=error_size,rng=rng)
+	except:
+		return False
+
+def simulate_crack(keys=None,bits=None,errorp=None,error_size=None,rng=None):
+	"""
+	Quantum half of crack_key: draws the key if needed and runs Shor's algorithm on its modulus.
+	Returns (public key, private key, a, output of run_algorithm), or None for the output if the simulation failed.
+	"""
+	public, private = keys if keys!= None else RSA.keys(2**3,rng=rng)
+	J=shor.shor(public[1],bits=bits if bits != None else 5,rng=rng)
+	try:
+		output = J.run_algorithm(errorp=errorp,error_size=error_size,rng=rng)
+	except:
+		output = None
+	return (public,private,J.a,output)
+
+def check_crack(simulated):
+	"""
+	Classical half of crack_key: finds the period and factors from the output of simulate_crack,
+	and returns whether they give the private key.
+	"""
+	public,private,a,output = simulated
+	try:
+		if output[1]:   # Check if the algorithm was skipped
+			factors = output[0]
+		else:
+			p = shor.get_period(output[0],a,public[1])
+			factors = shor.get_factors(p,a,public[1])
+		return get_private_key(factors,public) == private
+	except:
+		return False
+
+def main_pipelined(seed=None):
+	"""
+	Same experiment as main, with the period finding and key checks of finished shots running in a separate
+	process while later shots are still being simulated.
+	"""
+	keys = None # Can alternatively set this to keys=(public,private) to test against a constant key
+	shots = 100
+	maximum_bitnumber = 5
+	bit_sizes = [i+1 for i in range(maximum_bitnumber)]
+	jobs = [(keys,bitnumber) for bitnumber in bit_sizes for i in range(shots)]
+	results = np.array(list(pipeline.run_pipeline(simulate_crack,check_crack,jobs,seed=seed,verbose=True)),dtype=float).reshape(len(bit_sizes),shots)
+	y = np.mean(results,axis=1)
+	errors = np.std(results,axis=1)/np.sqrt(shots)
+	print(y)
+	fig,ax=plt.subplots()
+	ax.errorbar(bit_sizes, y, yerr=errors, fmt="o", ecolor="gray", elinewidth=0.75, capsize=3)
+	plt.xticks(bit_sizes)
+	ax.set_ylim([0, 1])
+	plt.xlabel("Number of Working Bits")
+	plt.ylabel("Success Probability")
+	plt.title("""Measured probability of successfully finding the RSA private key from a ramdom 3-bit public key
+for different sizes of the working register size for {} shots""".format(shots)
+		)
+	plt.show()
+
+def main(seed=None):
+	"""
+	seed = seed of the sweep. Results are only cached when it is given (int)
+	"""
 	public = (23,143)
 	private = (47,143)
 	keys = None # Can alternatively set this to keys=(public,private) to test against a constant key
 	shots = 100
 	maximum_bitnumber = 5 # 8-bit RSA requires an 8 qubit ancillary register, so limit this to 5 at max
 	bit_sizes = [i+1 for i in range(maximum_bitnumber)]
-	results = [[] for i in range(maximum_bitnumber)]
-	for bitnumber in bit_sizes:
-		print("Testing {} working bits".format(bitnumber))
-		#print("Public Key:",public)
-		#print("Private Key:",private)
-		for i in range(shots):
-			try:
-				result = crack_key(keys=keys,bits=bitnumber)
-				if result:
-					results[bitnumber-1].append(1)
-				else:
-					results[bitnumber-1].append(0)
-			except:
-				results[bitnumber-1].append(0)
-			print("Completed {}/{} shots".format(i+1,shots),end="\r",flush=True)
-		print("\n")
-	y = []
-	errors = []
-	for result_list in results:
-		y.append(np.mean(result_list))
-		errors.append(np.std(result_list)/np.sqrt(shots))
-	print(results)
+	y,errors = sweep.run_sweep(functools.partial(crack_shot,keys=keys),{"bits":bit_sizes},1,shots,seed=seed,cache=result_cache.ResultCache())	# Each shot is its own trial
+	print(y)
 	fig,ax=plt.subplots()
 	ax.errorbar(bit_sizes, y, yerr=errors, fmt="o", ecolor="gray", elinewidth=0.75, capsize=3)
 	plt.xticks(bit_sizes)
@@ -112,64 +159,51 @@ for different sizes of the working register size for {} shots""".format(shots)
 # 		)	# Use this plot title if working with a fixed public, private key pairing!
 	plt.show()
 
-def test_errorp():
+def test_errorp(log=None,seed=None):
+	"""
+	log = file every completed trial is appended to. Rerunning with the same log resumes an interrupted sweep (str)
+	seed = seed of the sweep. Results are only cached when it is given (int)
+	"""
 	public = (23,143)
 	private = (47,143)
 	keys = None # Can alternatively set this to keys=(public,private) to test against a constant key
-	y = [[] for i in range(3)]
-	errors = [[] for i in range(3)]
 	error_size_list = [0.1,0.2,0.3]
-	for num,error_size in enumerate(error_size_list):
-		print("------------------------------------------")
-		print("Error Size = {}".format(error_size))
-
-		bitnumber = 4
-		shots = 100
-		trials = 5
-		errorp_step = 0.5
-
-		errorp_list = np.array([i*errorp_step for i in range(int(1/errorp_step)+1)])
-		results = [[] for i in range(int(1/errorp_step)+1)]
-		for errorp in errorp_list:
-			print("Testing errorp={}".format(errorp))
-			for j in range(trials):
-				temp = []
-				for i in range(shots):
-					try:
-						result = crack_key(keys=keys,bits=bitnumber)
-						if result:
-							temp.append(1)
-						else:
-							temp.append(0)
-					except:
-						temp.append(0)
-					print("Completed {}/{} shots, {}/{} trials".format(i+1,shots,j,trials),end="\r",flush=True)
-				success = np.mean(temp)
-				results[int(errorp/errorp_step)].append(success)
-			print("Completed {}/{} shots, {}/{} trials".format(i+1,shots,trials,trials),end="\r",flush=True)
-			print("\n")
-		for result_list in results:
-			y[num].append(np.mean(result_list))
-			errors[num].append(np.std(result_list)/np.sqrt(trials))
-
-	folder = str(int(np.floor(time.time())))+"/"
-	os.mkdir(folder)
-	write(y,folder+"y")
-	write(errors,folder+"errors")
-	
-
-def plot_data(y_file,err_file):
-	y = read(y_file)
-	errors  = read(err_file)
-	error_size_list = [0.1,0.2,0.3]
-	
-	
 	bitnumber = 4
 	shots = 100
 	trials = 5
 	errorp_step = 0.5
 
 	errorp_list = np.array([i*errorp_step for i in range(int(1/errorp_step)+1)])
+	shot = functools.partial(crack_shot,keys=keys,bits=bitnumber)
+	grid = {"error_size":error_size_list,"errorp":list(errorp_list)}
+	cache = result_cache.ResultCache() if seed != None else None
+	if seed is None and log is None:
+		seed = np.random.SeedSequence().entropy	# Drawn here so that it is saved with the results
+	y,errors = sweep.run_sweep(shot,grid,shots,trials,seed=seed,log=log,cache=cache)
+	if seed is None:	# Resumed from the log, or started there
+		seed = sweep.get_log_seed(log,shot,grid,shots)
+
+	folder = str(int(np.floor(time.time())))
+	parameters = {"public":public,"keys":keys,"bits":bitnumber,"shots":shots,"trials":trials,"error_size":error_size_list,"errorp":errorp_list.tolist()}
+	metadata = {"algorithm":"RSA_breaker.crack_key","parameters":parameters,"backend":"numpy","error_model":"rotation",
+		"log":log,"seed":seed}
+	results_store.save_results(folder,{"y":y,"errors":errors,"errorp":errorp_list,"error_size":error_size_list},metadata=metadata)
+	print("Results saved to {}".format(folder))
+
+def plot_data(folder):
+	"""
+	Plots the results of test_errorp saved in a folder. Folders of pickled y and errors lists from
+	before results were saved with results_store are read too, using the parameters they were run with.
+	"""
+	results = results_store.load_results(folder)
+	y = results["y"]
+	errors = results["errors"]
+	parameters = results.metadata.get("parameters",{"bits":4,"shots":100,"trials":5,"error_size":[0.1,0.2,0.3],"errorp":[0,0.5,1]})
+	error_size_list = parameters["error_size"]
+	bitnumber = parameters["bits"]
+	shots = parameters["shots"]
+	trials = parameters["trials"]
+	errorp_list = np.array(parameters["errorp"])
 	
 	shapes = ["o","v","*"]
 	b = [-0.075,0,0.075]
@@ -193,6 +227,6 @@ Working Register = {} Qubits""".format(trials,shots,bitnumber)
 if __name__=="__main__":
 	main()
 	#test_errorp()
-	#plot_data("1678447330/y","1678447330/errors")
+	#plot_data("1678447330")
 	#while True:
 	#	crack_key(verbose=True)
\ No newline at end of file
@@ -0,0 +1,102 @@
+import numpy as np
+import ast, operator
+import data_reader
+
+COMPARISONS = {ast.Lt:operator.lt,ast.LtE:operator.le,ast.Gt:operator.gt,ast.GtE:operator.ge,ast.Eq:operator.eq,ast.NotEq:operator.ne}
+
+def load_catalogue(filename=None,columns=None,dtypes=None):
+	"""
+	Loads named columns of a raw catalogue such as data.csv, together with the ESI of every planet,
+	as a dictionary of numpy arrays padded to a power of 2 in length so they can index a Grover register.
+	Padding holds NaN (or empty text) and is flagged False in the "valid" column.
+	filename = Name of the catalogue .csv file (str)
+	columns = Names of the columns to load, as given in the header line (list)
+	dtypes = Numpy dtype of each column. Columns not listed are read as floats (dict)
+	"""
+	filename = filename if filename != None else "data.csv"
+	columns = columns if columns != None else ["name","mass","radius","temp_calculated","discovered"]
+	dtypes = dtypes if dtypes != None else {"name":str}
+	wanted = list(dict.fromkeys(columns+["mass","radius","temp_calculated"]))	# The ESI needs these too
+	chunks = list(data_reader.extract_columns(filename,wanted,dtypes=dtypes))
+	catalogue = {column:np.concatenate([chunk[column] for chunk in chunks]) for column in wanted}
+	catalogue["esi"] = data_reader.compute_ESI(catalogue["mass"],catalogue["radius"],catalogue["temp_calculated"])
+	length = len(catalogue["esi"])
+	entries = 2**int(np.ceil(np.log2(length)))
+	for column,values in catalogue.items():
+		padding = np.full(entries-length,"" if values.dtype.kind == "U" else np.nan,dtype=values.dtype)
+		catalogue[column] = np.concatenate([values,padding])
+	catalogue["valid"] = np.arange(entries) < length
+	return catalogue
+
+def compile_query(query=None):
+	"""
+	Compiles a predicate over named catalogue columns, for example "ESI > 0.8 and radius < 1.5 and discovered > 2015",
+	into a function that evaluates it over a whole catalogue at once and returns a boolean mask.
+	Supports and, or, not, brackets, chained comparisons, numbers and quoted text. Column names are case insensitive.
+	Entries with missing values never satisfy a comparison.
+	query = the predicate (str)
+	"""
+	if query is None:
+		raise SyntaxError("Query not specified")
+	tree = ast.parse(query,mode="eval").body
+
+	def evaluate(node,catalogue):
+		if isinstance(node,ast.BoolOp):
+			masks = [evaluate(value,catalogue) for value in node.values]
+			combine = np.logical_and if isinstance(node.op,ast.And) else np.logical_or
+			return combine.reduce(masks)
+		if isinstance(node,ast.UnaryOp) and isinstance(node.op,ast.Not):
+			known = True	# Entries with a missing value stay unselected when the predicate is negated
+			for name in ast.walk(node.operand):
+				if isinstance(name,ast.Name):
+					values = evaluate(name,catalogue)
+					if values.dtype.kind == "f":
+						known = np.logical_and(known,~np.isnan(values))
+			return np.logical_and(np.logical_not(evaluate(node.operand,catalogue)),known)
+		if isinstance(node,ast.Compare):
+			mask = True
+			left = evaluate(node.left,catalogue)
+			for op,comparator in zip(node.ops,node.comparators):
+				if type(op) not in COMPARISONS:
+					raise SyntaxError("Unsupported comparison in query: {}".format(query))
+				right = evaluate(comparator,catalogue)
+				left_value,right_value = left,right
+				if isinstance(left,np.ndarray) and left.dtype.kind == "S" and isinstance(right,str):
+					right_value = right.encode("utf-8")
+				if isinstance(right,np.ndarray) and right.dtype.kind == "S" and isinstance(left,str):
+					left_value = left.encode("utf-8")
+				mask = np.logical_and(mask,COMPARISONS[type(op)](left_value,right_value))
+				for value in (left,right):	# nan != x is True, so missing values are excluded explicitly
+					if isinstance(value,np.ndarray) and value.dtype.kind == "f":
+						mask = np.logical_and(mask,~np.isnan(value))
+				left = right
+			return mask
+		if isinstance(node,ast.Name):
+			columns = {column.lower():column for column in catalogue}
+			if node.id.lower() not in columns:
+				raise KeyError("Unknown column in query: {}".format(node.id))
+			return np.asarray(catalogue[columns[node.id.lower()]])
+		if isinstance(node,ast.Constant) and isinstance(node.value,(int,float,str)):
+			return node.value
+		if isinstance(node,ast.UnaryOp) and isinstance(node.op,ast.USub) and isinstance(node.operand,ast.Constant):
+			return -node.operand.value
+		raise SyntaxError("Unsupported expression in query: {}".format(query))
+
+	def query_mask(catalogue):
+		"""
+		catalogue = named columns of equal length (dict of numpy arrays, or a structured numpy array)
+		"""
+		if isinstance(catalogue,np.ndarray):
+			catalogue = {column:catalogue[column] for column in catalogue.dtype.names}
+		mask = np.broadcast_to(evaluate(tree,catalogue),len(next(iter(catalogue.values()))))
+		if "valid" in catalogue:
+			mask = mask & catalogue["valid"]	# Padding is never selected
+		return np.array(mask,dtype=bool)
+
+	return query_mask
+
+def query_mask(query,catalogue):
+	"""
+	Evaluates a predicate over a whole catalogue in one pass. See compile_query.
+	"""
+	return compile_query(query)(catalogue)
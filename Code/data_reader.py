@@ -1,4 +1,5 @@
-import csv
+import csv, glob, os, shutil, tempfile
+import numpy as np
 
 def trim_csv_data(filename=None,wanted_indices=None):
 	"""
@@ -23,11 +24,188 @@ def trim_csv_data(filename=None,wanted_indices=None):
 			trimmed_data.append(trimmed_line)	# Append the trimmed line to the new list
 		return trimmed_data
 
+def read_header(line):
+	"""
+	Returns the column names of a header line, allowing for a leading "# " as in data.csv.
+	line = first line of the file, as split by csv.reader (list)
+	"""
+	names = [name.strip() for name in line]
+	names[0] = names[0].lstrip("#").strip()
+	return names
+
+def convert_chunk(values,dtype):
+	"""
+	Converts a column of strings from a .csv file to a numpy array. Missing float entries become NaN.
+	"""
+	values = np.array(values,dtype=object)
+	if np.dtype(dtype).kind == "f":
+		values[values == ""] = "nan"
+	return values.astype(dtype)
+
+def extract_columns(filename=None,columns=None,dtypes=None,chunk_size=None,dropna=None):
+	"""
+	Streams selected columns of a large .csv file, yielding them in chunks as typed numpy arrays.
+	Only one chunk is held in memory at a time. Each chunk is a dictionary of column name to array.
+	filename = Name of the .csv file (str)
+	columns = Names of the columns to extract, as given in the header line (list)
+	dtypes = Numpy dtype of each column. Columns not listed are read as floats (dict)
+	chunk_size = Number of lines per chunk (int)
+	dropna = Skip lines that are missing any of the extracted entries (bool)
+	"""
+	if filename is None:
+		raise SyntaxError("Filename not specified")
+	if columns is None:
+		raise SyntaxError("Columns to extract not specified")
+	dtypes = dtypes if dtypes != None else {}
+	chunk_size = chunk_size if chunk_size != None else 65536
+	dropna = dropna if dropna != None else False
+	with open(filename,newline="") as f:
+		data = csv.reader(f,delimiter=",")
+		header = read_header(next(data))
+		wanted_indices = [header.index(column) for column in columns]
+		chunk = [[] for column in columns]
+		for line in data:
+			entries = [line[j] for j in wanted_indices]
+			if dropna and "" in entries:
+				continue
+			for values,entry in zip(chunk,entries):
+				values.append(entry)
+			if len(chunk[0]) == chunk_size:
+				yield {column:convert_chunk(values,dtypes.get(column,float)) for column,values in zip(columns,chunk)}
+				chunk = [[] for column in columns]
+		if len(chunk[0]) > 0:
+			yield {column:convert_chunk(values,dtypes.get(column,float)) for column,values in zip(columns,chunk)}
+
+def write_columns(chunks=None,filename=None,header=None,string_width=None):
+	"""
+	Writes chunks from extract_columns to disk as they arrive, either as a .csv file or, if the filename
+	ends in .npy, as a structured numpy array. The binary rows are streamed to a temporary file and
+	copied behind the .npy header once the final length is known, so memory use stays bounded.
+	chunks = Chunks of columns, as yielded by extract_columns (iterable)
+	filename = Name of the output file (str)
+	header = Write the column names as the first line of a .csv file (bool)
+	string_width = Maximum length of text entries in a .npy file (int)
+	"""
+	if filename is None:
+		raise SyntaxError("Output filename not specified")
+	header = header if header != None else True
+	string_width = string_width if string_width != None else 64
+	if not filename.endswith(".npy"):
+		with open(filename,"w+",newline="") as g:
+			writer = csv.writer(g,delimiter=",")
+			for i,chunk in enumerate(chunks):
+				if i == 0 and header:
+					writer.writerow(list(chunk))
+				writer.writerows(zip(*chunk.values()))
+		return
+
+	dtype = None
+	length = 0
+	with tempfile.TemporaryFile() as raw:
+		for chunk in chunks:
+			if dtype is None:
+				dtype = np.dtype([(column,"U{}".format(string_width) if values.dtype.kind == "U" else values.dtype) for column,values in chunk.items()])
+			records = np.empty(len(next(iter(chunk.values()))),dtype=dtype)
+			for column,values in chunk.items():
+				records[column] = values
+			raw.write(records.tobytes())
+			length += len(records)
+		raw.seek(0)
+		with open(filename,"wb") as g:
+			np.lib.format.write_array_header_1_0(g,{"descr":np.lib.format.dtype_to_descr(dtype),"fortran_order":False,"shape":(length,)})
+			shutil.copyfileobj(raw,g)
+
+# Units and Earth reference values used for the Earth Similarity Index, as in FINALESI.py
+G = 6.67e-11				# Gravitational constant (m^3*kg^-1*s^-2)
+JUPITER_MASS = 1.898e27		# kg
+JUPITER_RADIUS = 69911000	# m
+EARTH_VALUES = {"radius":6371000,"density":5520,"escape_velocity":11186,"temperature":288}
+ESI_WEIGHTS = {"radius":0.57,"density":1.07/2,"escape_velocity":0.7/3,"temperature":5.58/4}
+
+def compute_ESI(mass,radius,temperature):
+	"""
+	Vectorised Earth Similarity Index of every planet. Planets with a missing entry get NaN.
+	mass = planetary masses in Jupiter masses (numpy array)
+	radius = planetary radii in Jupiter radii (numpy array)
+	temperature = planetary temperatures in Kelvin (numpy array)
+	"""
+	radius = np.asarray(radius,dtype=float)*JUPITER_RADIUS
+	mass = np.asarray(mass,dtype=float)*JUPITER_MASS
+	values = {
+		"radius":radius,
+		"density":mass/((4/3)*np.pi*radius**3),
+		"escape_velocity":np.sqrt(2*G*mass/radius),
+		"temperature":np.asarray(temperature,dtype=float)}
+	esi = np.ones(len(radius))
+	for quantity,x in values.items():
+		earth = EARTH_VALUES[quantity]
+		esi *= (1-np.abs((x-earth)/(x+earth)))**ESI_WEIGHTS[quantity]
+	return esi
+
+def pad_ESI_data(names,esi):
+	"""
+	Packs names and ESI values into a structured numpy array padded to a power of 2 in length.
+	Fields are name (bytes), esi (float, NaN for padding) and valid (False for padding).
+	"""
+	names = [name.encode("utf-8") for name in names]
+	bits = int(np.ceil(np.log2(len(names))))
+	width = max(len(name) for name in names)
+	database = np.zeros(2**bits,dtype=[("name","S{}".format(width)),("esi","f8"),("valid","?")])
+	database["esi"] = np.nan	# Ensure the padding never compares as a match
+	database["name"][:len(names)] = names
+	database["esi"][:len(names)] = esi
+	database["valid"][:len(names)] = True
+	return database
+
+def build_ESI_data(filename=None,output=None):
+	"""
+	Computes the ESI of every planet in a raw catalogue such as data.csv, skipping planets with missing
+	mass, radius or temperature, and returns the search database in the same form as load_ESI_data.
+	filename = Name of the catalogue .csv file (str)
+	output = Name of a Name,ESI .csv file to also write the results to (str)
+	"""
+	filename = filename if filename != None else "data.csv"
+	names,esi = [],[]
+	for chunk in extract_columns(filename,["name","mass","radius","temp_calculated"],dtypes={"name":str}):
+		chunk_esi = compute_ESI(chunk["mass"],chunk["radius"],chunk["temp_calculated"])
+		valid = ~np.isnan(chunk_esi)
+		names.extend(chunk["name"][valid])
+		esi.append(chunk_esi[valid])
+	esi = np.concatenate(esi)
+	if output is not None:
+		write_columns([{"Name":np.array(names),"ESI":esi}],output)
+	return pad_ESI_data(names,esi)
+
+def load_ESI_data(filename=None):
+	"""
+	Loads a Name,ESI catalogue into a structured numpy array padded to a power of 2 in length.
+	Fields are name (bytes), esi (float, NaN for padding) and valid (False for padding).
+	The parsed array is cached next to the .csv file, keyed on the file's size and modification time,
+	and the cache is memory mapped so repeated runs skip parsing the .csv file entirely.
+	filename = Name of the .csv file (str)
+	"""
+	if filename is None:
+		raise SyntaxError("ESI file not specified")
+	stat = os.stat(filename)
+	cache = "{}.{}_{}.npy".format(filename,stat.st_size,stat.st_mtime_ns)
+	if os.path.exists(cache):
+		return np.load(cache,mmap_mode="r")
+
+	with open(filename,newline="") as f:
+		data = csv.reader(f,delimiter=",")
+		next(data)	# Skip the Name,ESI line at the start of the file
+		rows = [(line[0],float(line[1])) for line in data]
+	database = pad_ESI_data([name for name,esi in rows],[esi for name,esi in rows])
+
+	for stale in glob.glob(glob.escape(filename)+".*_*.npy"):	# Caches of older versions of the file
+		os.remove(stale)
+	np.save(cache,database)
+	return np.load(cache,mmap_mode="r")
+
 def main():
-	trimmed = trim_csv_data("data.csv",[0,2,8]) # Extract 1st and 3rd entry from each line (name and mass of planet)
-	with open("trimmed_data.csv","w+",newline="") as g:
-		writer = csv.writer(g,delimiter=',')
-		writer.writerows(trimmed)
+	# Extract the name, mass and radius of each planet, skipping planets with missing entries
+	chunks = extract_columns("data.csv",["name","mass","radius"],dtypes={"name":str},dropna=True)
+	write_columns(chunks,"trimmed_data.csv",header=False)
 
 if __name__=="__main__":
 	main()
\ No newline at end of file
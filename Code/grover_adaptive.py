@@ -1,7 +1,8 @@
 import numpy as np
 import cupy as cp
 import matplotlib.pyplot as plt
-import random, csv
+import random
+import data_reader
 import quantum_backend_GPU as quantum
 
 
@@ -14,21 +15,12 @@ def get_database(bits):
 	return database
 
 def import_ESI_data():
-	with open("esi.csv",newline="") as file:
-		data_reader = csv.reader(file,delimiter=",")
-		data = [row for row in data_reader]
-		del data[0]		# Remove Names/ESI line at the start of the file
-		data_length = len(data)
-		bits = int(np.ceil(np.log2(data_length)))
-		entries = 2**bits
-		for i in range(entries-data_length):	# Ensure the database length is a power of 2
-			data.append(None)
-	return data
+	return data_reader.load_ESI_data("esi.csv")
 
 def adaptive_oracle(x,x_0,database):
-	Y = database[x_0][1]
+	Y = database["esi"][x_0]
 	try:
-		if database[x][1] > Y:
+		if database["esi"][x] > Y:	# Padding entries hold NaN, which never compares as greater
 			return True
 		else:
 			return False
@@ -45,23 +37,28 @@ def adaptive_oracle2(x,x_0,database):
 	except:
 		return False
 
-def adaptive_search(database,threshold):
+def adaptive_search(database,threshold,rng=None):
+	"""
+	rng = random number generator, see quantum_backend_GPU.get_rng (numpy Generator)
+	"""
+	rng = quantum.get_rng(rng)
 	bits = int(np.ceil(np.log2(len(database))))
 	while True:
-		x_0 = random.randint(0,len(database)-1)
+		x_0 = int(rng.integers(0,len(database)))
 		if database[x_0] is not None:
 			break
 	scaling = 1.34
 	m = 1
 	fails = 0
+	J = quantum.Grover(lambda x: adaptive_oracle2(x,x_0,database),bits)
 	while fails < threshold:
-		iterations = random.randint(1,np.ceil(m))
-		J = quantum.Grover(lambda x: adaptive_oracle2(x,x_0,database),bits)
-		q = J.search(iterations,errorp=0.2)
-		x_1 = quantum.measure(q)
+		iterations = int(rng.integers(1,int(np.ceil(m))+1))
+		q = J.search(iterations,errorp=0.2,rng=rng)
+		x_1 = quantum.measure(q,rng=rng)
 		if adaptive_oracle2(x_1,x_0,database):
 			x_0 = x_1
 			fails = 0
+			J.set_oracle(lambda x: adaptive_oracle2(x,x_0,database))	# New threshold, so cached states are discarded
 		else:
 			fails += 1
 		m = min(scaling*m,np.sqrt(2**bits))
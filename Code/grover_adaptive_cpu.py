@@ -1,7 +1,12 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import random, csv
+import random, time
+import functools
+import sweep, results_store
+import data_reader
 import quantum_backend as quantum
+import quantum_counting
+import catalogue_query
 
 
 def get_database(bits):
@@ -13,21 +18,12 @@ def get_database(bits):
 	return database
 
 def import_ESI_data():
-	with open("esi.csv",newline="") as file:
-		data_reader = csv.reader(file,delimiter=",")
-		data = [row for row in data_reader]
-		del data[0]		# Remove Names/ESI line at the start of the file
-		data_length = len(data)
-		bits = int(np.ceil(np.log2(data_length)))
-		entries = 2**bits
-		for i in range(entries-data_length):	# Ensure the database length is a power of 2
-			data.append(None)
-	return data
+	return data_reader.load_ESI_data("esi.csv")
 
 def adaptive_oracle(x,x_0,database):
-	Y = database[x_0][1]
+	Y = database["esi"][x_0]
 	try:
-		if database[x][1] > Y:
+		if database["esi"][x] > Y:	# Padding entries hold NaN, which never compares as greater
 			return True
 		else:
 			return False
@@ -44,38 +40,177 @@ def adaptive_oracle2(x,x_0,database):
 	except:
 		return False
 
-def adaptive_search(database,threshold):
+def adaptive_search(database,threshold,rng=None):
+	"""
+	rng = random number generator, see quantum_backend.get_rng (numpy Generator)
+	"""
+	rng = quantum.get_rng(rng)
 	bits = int(np.ceil(np.log2(len(database))))
 	while True:
-		x_0 = random.randint(0,len(database)-1)
+		x_0 = int(rng.integers(0,len(database)))
 		if database[x_0] is not None:
 			break
 	scaling = 1.34
 	m = 1
 	fails = 0
+	J = quantum.Grover(lambda x: adaptive_oracle2(x,x_0,database),bits)
 	while fails < threshold:
-		iterations = random.randint(1,np.ceil(m))
-		J = quantum.Grover(lambda x: adaptive_oracle2(x,x_0,database),bits)
+		iterations = int(rng.integers(1,int(np.ceil(m))+1))
 		q = J.search(iterations)
-		x_1 = quantum.measure(q)
+		x_1 = quantum.measure(q,rng=rng)
 		if adaptive_oracle2(x_1,x_0,database):
 			x_0 = x_1
 			fails = 0
+			J.set_oracle(lambda x: adaptive_oracle2(x,x_0,database))	# New threshold, so cached states are discarded
 		else:
 			fails += 1
 		m = min(scaling*m,np.sqrt(2**bits))
 	del J
 	return x_0
 
-def multi_trial_durr_hoyer(shots,trials,database,threshold):
-	outputs = [[] for i in range(trials)]
+def bbht_adaptive_search(database,threshold,rng=None):
+	"""
+	Durr-Hoyer minimum search where each improvement step is a BBHT exponential search,
+	so iteration counts follow the optimal schedule instead of a hand-tuned scaling factor.
+	threshold = number of consecutive BBHT searches without an improvement before stopping (int)
+	rng = random number generator, see quantum_backend.get_rng (numpy Generator)
+	"""
+	rng = quantum.get_rng(rng)
+	bits = int(np.ceil(np.log2(len(database))))
+	while True:
+		x_0 = int(rng.integers(0,len(database)))
+		if database[x_0] is not None:
+			break
+	fails = 0
+	J = quantum.Grover(lambda x: adaptive_oracle2(x,x_0,database),bits)
+	while fails < threshold:
+		x_1,calls = quantum.bbht_search(J,rng=rng)
+		if x_1 is not None:
+			x_0 = x_1
+			fails = 0
+			J.set_oracle(lambda x: adaptive_oracle2(x,x_0,database))
+		else:
+			fails += 1
+	del J
+	return x_0
+
+def counting_adaptive_search(database,threshold,precision=None,rng=None):
+	"""
+	Durr-Hoyer minimum search where each step estimates the number of better entries with quantum
+	counting and jumps straight to the near-optimal iteration count for that estimate.
+	threshold = number of consecutive steps without an improvement before stopping (int)
+	precision = number of qubits in the counting register (int)
+	rng = random number generator, see quantum_backend.get_rng (numpy Generator)
+	"""
+	rng = quantum.get_rng(rng)
+	bits = int(np.ceil(np.log2(len(database))))
+	while True:
+		x_0 = int(rng.integers(0,len(database)))
+		if database[x_0] is not None:
+			break
+	fails = 0
+	J = quantum.Grover(lambda x: adaptive_oracle2(x,x_0,database),bits)
+	while fails < threshold:
+		x_1,marked = quantum_counting.counted_search(J,precision=precision,rng=rng)
+		if x_1 is not None and adaptive_oracle2(x_1,x_0,database):
+			x_0 = x_1
+			fails = 0
+			J.set_oracle(lambda x: adaptive_oracle2(x,x_0,database))
+		else:
+			fails += 1
+	del J
+	return x_0
+
+def batch_adaptive_search(database,threshold,shots,rng=None):
+	"""
+	Runs many shots of adaptive_search in lockstep, evolving the Grover searches of every
+	unfinished shot together as one batch. Returns the output of each shot.
+	shots = number of independent searches to run (int)
+	rng = random number generator, see quantum_backend.get_rng (numpy Generator)
+	"""
+	rng = quantum.get_rng(rng)
+	values = np.array([np.nan if entry is None else entry for entry in database],dtype=float)
+	valid = np.flatnonzero(~np.isnan(values))
+	x_0 = rng.choice(valid,size=shots)
+	scaling = 1.34
+	m = np.ones(shots)
+	fails = np.zeros(shots,dtype=int)
+	J = quantum.GroverBatch(values[None,:] < values[x_0][:,None])
+	while np.any(fails < threshold):
+		active = fails < threshold
+		iterations = np.where(active,rng.integers(1,np.ceil(m).astype(int)+1),0)
+		J.set_oracle(values[None,:] < values[x_0][:,None])
+		x_1 = quantum.measure_batch(J.search(iterations),rng=rng)
+		improved = active & (values[x_1] < values[x_0])
+		x_0 = np.where(improved,x_1,x_0)
+		fails = np.where(improved,0,np.where(active,fails+1,fails))
+		m = np.where(active,np.minimum(scaling*m,np.sqrt(len(database))),m)
+	del J
+	return list(x_0)
+
+def query_adaptive_search(catalogue,query,threshold,column=None,rng=None):
+	"""
+	Durr-Hoyer maximum search restricted to the catalogue entries that satisfy a query, for example
+	the most Earth-like planet with "radius < 1.5 and discovered > 2015". Each oracle marks the entries
+	that satisfy the query and beat the current best, and is built from one compiled mask.
+	Returns the index of the best entry found, or None if no entry satisfies the query.
+	catalogue = named columns padded to a power of 2 in length, as returned by catalogue_query.load_catalogue (dict)
+	query = predicate over the catalogue columns (str)
+	column = name of the column to maximise. Defaults to "esi" (str)
+	rng = random number generator, see quantum_backend.get_rng (numpy Generator)
+	"""
+	rng = quantum.get_rng(rng)
+	column = column if column != None else "esi"
+	values = np.asarray(catalogue[column],dtype=float)
+	subset = catalogue_query.compile_query(query)(catalogue) & ~np.isnan(values)
+	if not np.any(subset):
+		return None
+	bits = int(np.ceil(np.log2(len(values))))
+	x_0 = int(rng.choice(np.flatnonzero(subset)))
+	scaling = 1.34
+	m = 1
+	fails = 0
+	J = quantum.Grover(subset & (values > values[x_0]),bits)
+	while fails < threshold:
+		iterations = int(rng.integers(1,int(np.ceil(m))+1))
+		q = J.search(iterations)
+		x_1 = quantum.measure(q,rng=rng)
+		if subset[x_1] and values[x_1] > values[x_0]:
+			x_0 = int(x_1)
+			fails = 0
+			J.set_oracle(subset & (values > values[x_0]))
+		else:
+			fails += 1
+		m = min(scaling*m,np.sqrt(2**bits))
+	del J
+	return x_0
+
+def durr_hoyer_shot(database,threshold,search_function,rng=None):
+	"""
+	Runs one Durr-Hoyer search for a sweep and returns its output as a one-hot array over the database.
+	"""
 	bits = int(np.ceil(np.log2(len(database))))
+	return np.bincount([search_function(database,threshold,rng=rng)],minlength=2**bits)
+
+def multi_trial_durr_hoyer(shots,trials,database,threshold,search_function=None,batched=None,processes=None):
+	"""
+	search_function = Durr-Hoyer implementation to run for each shot. Defaults to adaptive_search (function)
+	batched = run all the shots of a trial together with batch_adaptive_search (bool)
+	processes = number of worker processes the shots are spread across, see sweep.run_sweep (int)
+	"""
+	search_function = search_function if search_function != None else adaptive_search
+	batched = batched if batched != None else False
+	bits = int(np.ceil(np.log2(len(database))))
+	if not batched:
+		shot = functools.partial(durr_hoyer_shot,database=database,threshold=threshold,search_function=search_function)
+		operators = quantum.Grover(lambda x: False,bits).get_operators()	# Built once, attached by every worker
+		shared = {"grover_{}/{}".format(bits,name):array for name,array in operators.items()}
+		outputs = sweep.run_sweep(shot,{},shots,trials,processes=processes,raw=True,shared=shared)
+		return np.round(outputs*shots).astype(int).T.tolist()	# Frequency of each output in each trial
+	outputs = [[] for i in range(trials)]
 	for j in range(trials):
-		for i in range(shots):
-			t = adaptive_search(database,threshold)
-			outputs[j].append(t)
-			print("Completed {}/{} shots, {}/{} trials".format(i+1,shots,j,trials),end="\r",flush=True)
-	print("Completed {}/{} shots, {}/{} trials".format(shots,shots,trials,trials),end="\r",flush=True)	
+		outputs[j] = batch_adaptive_search(database,threshold,shots)
+		print("Completed {}/{} shots, {}/{} trials".format(shots,shots,j+1,trials),end="\r",flush=True)
 	print("\nDone!")
 	freq = [[0 for i in range(trials)] for j in range(2**bits)]
 	for i in range(len(outputs)):
@@ -88,12 +223,32 @@ def main1(shots,trials,bits):
 	database = get_database(bits)
 
 	freq = multi_trial_durr_hoyer(shots,trials,database,threshold)
-	x = np.array([i for i in range(2**bits)])
-	y,errors = [],[]
-	for freq_list in freq:
-		y.append(np.mean(freq_list))
-		errors.append(np.std(freq_list))
+	folder = str(int(np.floor(time.time())))
+	metadata = {"algorithm":"grover_adaptive_cpu.multi_trial_durr_hoyer","backend":"numpy",
+		"parameters":{"shots":shots,"trials":trials,"bits":bits,"threshold":threshold}}
+	results_store.save_results(folder,{"freq":np.array(freq,dtype=np.int32),"database":database},metadata=metadata)
+	print("Results saved to {}".format(folder))
+	plot_frequencies(folder)
+
+def plot_frequencies(folder,true_target_pos=None):
+	"""
+	Plots the output frequencies of multi_trial_durr_hoyer saved by main1. The frequency table is memory-mapped,
+	so only the row of the true target is read to report the fail rate.
+	true_target_pos = database register of the best entry (int)
+	"""
+	true_target_pos = true_target_pos if true_target_pos != None else 636
+	results = results_store.load_results(folder)
+	freq = results["freq"]
+	shots = results.metadata["parameters"]["shots"]
+	bits = results.metadata["parameters"]["bits"]
+	if true_target_pos < len(freq):
+		fail_rate=100-np.mean(freq[true_target_pos])
+		fail_rate_error=np.std(freq[true_target_pos])
+		print("Fail rate: ({} +/- {})%".format(fail_rate,fail_rate_error))
 
+	x = np.array([i for i in range(2**bits)])
+	y = np.mean(freq,axis=1)
+	errors = np.std(freq,axis=1)
 	plt.errorbar(x, y, yerr=errors, fmt="o", ecolor='gray', elinewidth=0.75, capsize=3)
 	plt.xlabel("Database Register")
 	plt.ylabel("Frequency")
@@ -105,10 +260,6 @@ def main1(shots,trials,bits):
 		"""Frequency plot of the Durr-Hoyer Algorithm for {} shots
 when applied to the ESI database to find the most habitable planet""".format(shots)
 		)
-	true_target_pos = 636
-	fail_rate=100-y[true_target_pos]
-	fail_rate_error=errors[true_target_pos]
-	print("Fail rate: ({} +/- {})%".format(fail_rate,fail_rate_error))
 	plt.show()
 
 def main2(shots,trials,bits):
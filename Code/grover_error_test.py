@@ -2,61 +2,42 @@ import numpy as np
 import cupy as cp
 import matplotlib.pyplot as plt
 import random, time
+import functools
+import sweep, result_cache
 import quantum_backend_GPU as quantum
+import noise_model
 
 
-def main():
-	y = [[] for i in range(3)]
-	errors = [[] for i in range(3)]
-	error_size_list = [0.01,0.05,0.1]
+@functools.lru_cache(maxsize=None)
+def get_grover(bits):
+	return quantum.Grover(lambda x: x == 0,bits,verbose=False)	# One instance per worker, so its cached states are reused
+
+def search_shot(bits,iterations,errorp,error_size,rng=None):
+	"""
+	Runs one noisy Grover search for the state 0 and returns whether it was measured.
+	Errors are raised rather than counted as failed searches, so they cannot pass for data.
+	"""
+	J = get_grover(bits)
+	t = J.search(iterations,errorp=errorp,error_size=error_size,rng=rng)
+	return quantum.measure(t,rng=rng) == 0
 
-	database = []
+def main(processes=None,seed=None):
+	"""
+	processes = number of worker processes. Defaults to 1, as every worker would create its own CUDA context
+	    and copy of the operators on the same GPU (int)
+	seed = seed of the sweep. Results are only cached when it is given (int)
+	"""
+	processes = processes if processes != None else 1
+	error_size_list = [0.01,0.05,0.1]
 	bits = 5
-	length = 2**bits
-	for i in range(length):
-		database.append(0)
 	targets=1
-	for i in range(targets):
-		database[0]=1
-	iterations = int(np.ceil(np.sqrt(len(database)/targets)))
-
-	def f(x):
-		if database[x] == 1:
-			return True
-		else:
-			return False
-
-	for num,error_size in enumerate(error_size_list):
-		print("------------------------------------------")
-		print("Error Size = {}".format(error_size))
-		shots = 100
-		trials = 20
-		errorp_step = 0.2
-		errorp_list = np.array([i*errorp_step for i in range(int(1/errorp_step)+1)])
-		results = [[] for i in range(int(1/errorp_step)+1)]
-		for errorp in errorp_list:
-			print("Testing errorp={}".format(errorp))
-			for j in range(trials):
-				temp = []
-				for i in range(shots):
-					try:
-						J = quantum.Grover(f,bits,verbose=False)
-						t = J.search(iterations,errorp=errorp,error_size=error_size)
-						result = quantum.measure(t)
-						if result == 0:
-							temp.append(1)
-						else:
-							temp.append(0)
-					except:
-						temp.append(0)
-					print("Completed {}/{} shots, {}/{} trials".format(i+1,shots,j,trials),end="\r",flush=True)
-				success = np.mean(temp)
-				results[int(errorp/errorp_step)].append(success)
-			print("Completed {}/{} shots, {}/{} trials".format(i+1,shots,trials,trials),end="\r",flush=True)
-			print("\n")
-		for result_list in results:
-			y[num].append(np.mean(result_list))
-			errors[num].append(np.std(result_list)/np.sqrt(trials))
+	iterations = int(np.ceil(np.sqrt(2**bits/targets)))
+	shots = 100
+	trials = 20
+	errorp_step = 0.2
+	errorp_list = np.array([i*errorp_step for i in range(int(1/errorp_step)+1)])
+	shot = functools.partial(search_shot,bits=bits,iterations=iterations)
+	y,errors = sweep.run_sweep(shot,{"error_size":error_size_list,"errorp":list(errorp_list)},shots,trials,processes=processes,seed=seed,cache=result_cache.ResultCache())
 
 	b = [-0.05,0,0.05]
 	shapes = ["o","v","*"]
@@ -75,6 +56,76 @@ Working Register = {} Qubits""".format(trials,shots,bits)
 	plt.tight_layout()
 	plt.show()
 
+def main_stratified():
+	"""
+	Same sweep as main, using the stratified estimator on exact trajectory success probabilities
+	instead of 20 trials of 100 measured shots per point.
+	"""
+	error_size_list = [0.01,0.05,0.1]
+	bits = 5
+	targets = 1
+	iterations = int(np.ceil(np.sqrt(2**bits/targets)))
+	trajectories = 200
+	errorp_step = 0.2
+	errorp_list = np.array([i*errorp_step for i in range(int(1/errorp_step)+1)])
+	J = quantum.Grover(lambda x: x == 0,bits,verbose=False)
+	trajectory_success = lambda noise,fired: J.success_probability(iterations,noise=noise,fired=fired)
+
+	b = [-0.05,0,0.05]
+	shapes = ["o","v","*"]
+	fig,ax=plt.subplots()
+	for num,error_size in enumerate(error_size_list):
+		print("Error Size = {}".format(error_size))
+		y,lower,upper = [],[],[]
+		for errorp in errorp_list:
+			estimate,interval = noise_model.stratified_success(trajectory_success,3*iterations,errorp,trajectories,error_size=error_size)
+			y.append(estimate)
+			lower.append(estimate-interval[0])
+			upper.append(interval[1]-estimate)
+		ax.errorbar(errorp_list+b[num], y, yerr=[lower,upper], fmt=shapes[num], ecolor="gray", elinewidth=0.75, capsize=3, label=str(error_size))
+	plt.xticks(errorp_list)
+	plt.xlabel("Probability of error on a qubit")
+	plt.ylabel("Success Probability")
+	plt.legend(title="Error Size")
+	plt.title("""Stratified estimate of the probability of finding the target
+from {} noisy trajectories per point, with 95% confidence intervals.
+Working Register = {} Qubits""".format(trajectories,bits)
+)
+	plt.tight_layout()
+	plt.show()
+
+def main_crn():
+	"""
+	Success probability against errorp using common random numbers, so every trajectory sees the same
+	error draws at each errorp and the shape of the curve is resolved with few trajectories.
+	"""
+	error_size_list = [0.01,0.05,0.1]
+	bits = 5
+	targets = 1
+	iterations = int(np.ceil(np.sqrt(2**bits/targets)))
+	trajectories = 200
+	errorp_step = 0.2
+	errorp_list = np.array([i*errorp_step for i in range(int(1/errorp_step)+1)])
+	J = quantum.Grover(lambda x: x == 0,bits,verbose=False)
+	trajectory_success = lambda noise,fired: J.success_probability(iterations,noise=noise,fired=fired)
+
+	b = [-0.05,0,0.05]
+	shapes = ["o","v","*"]
+	fig,ax=plt.subplots()
+	for num,error_size in enumerate(error_size_list):
+		print("Error Size = {}".format(error_size))
+		y,lower,upper = noise_model.crn_success_curve(trajectory_success,3*iterations,errorp_list,trajectories,error_size=error_size)
+		ax.errorbar(errorp_list+b[num], y, yerr=[y-lower,upper-y], fmt=shapes[num], ecolor="gray", elinewidth=0.75, capsize=3, label=str(error_size))
+	plt.xticks(errorp_list)
+	plt.xlabel("Probability of error on a qubit")
+	plt.ylabel("Success Probability")
+	plt.legend(title="Error Size")
+	plt.title("""Common random number estimate of the probability of finding the target
+from {} noisy trajectories per point, with 95% confidence intervals.
+Working Register = {} Qubits""".format(trajectories,bits)
+)
+	plt.tight_layout()
+	plt.show()
 
 if __name__=="__main__":
 	main()
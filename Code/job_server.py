@@ -0,0 +1,232 @@
+import numpy as np
+import asyncio, concurrent.futures, functools, itertools, json, multiprocessing, os, socket, sys, traceback
+import quantum_backend as quantum
+import shor
+import sweep
+import shor_tester, RSA_breaker
+
+HOST = "127.0.0.1"
+PORT = 5379
+FACTORING_ERRORS = (ArithmeticError,TypeError,ValueError)	# From np.gcd on integers too large for int64, and degenerate periods
+SHOT_FUNCTIONS = {	# Shot functions a sweep job may name
+	"shor_tester.factorise_shot":shor_tester.factorise_shot,
+	"RSA_breaker.crack_shot":RSA_breaker.crack_shot,
+}
+
+def run_grover_batch(bits,marked,iterations):
+	"""
+	Exact outcome distributions of a batch of noiseless Grover searches of the same register size, one per row.
+	bits = number of qubits (int)
+	marked = marked states of each search (list of lists)
+	iterations = number of iterations of each search (list)
+	"""
+	masks = np.zeros((len(marked),2**bits),dtype=bool)
+	for row,states in enumerate(marked):
+		masks[row,states] = True
+	return quantum.GroverBatch(masks).distributions(iterations)
+
+def run_shor_job(N,a=None,bits=None,errorp=None,error_size=None,error_model=None,shots=None,seed=None):
+	"""
+	Runs shots of Shor's algorithm on N. Returns the pivot, the count of every measured phase and the
+	fraction of shots that found a non-trivial factor of N.
+	"""
+	shots = shots if shots != None else 100
+	rng = np.random.default_rng(seed)
+	J = shor.shor(N,a=a,bits=bits,rng=rng)
+	phases = {}
+	successes = 0
+	for i in range(shots):
+		output = J.run_algorithm(errorp=errorp,error_size=error_size,error_model=error_model,rng=rng)
+		try:
+			if output[1]:	# a was already a factor
+				factors = output[0]
+			else:
+				phases[str(output[0])] = phases.get(str(output[0]),0)+1
+				p = shor.get_period(output[0],J.a,N)
+				factors = shor.get_factors(p,J.a,N)
+			successes += any(1 < int(factor) < N and N%int(factor) == 0 for factor in factors)
+		except FACTORING_ERRORS:	# The shot failed to factorise N
+			continue
+	return {"a":J.a,"phases":phases,"success":successes/shots}
+
+class JobServer:
+
+	def __init__(self,host=None,port=None,workers=None,batch_window=None,max_batch=None,max_bits=None):
+		"""
+		Local job service for simulations. Clients send jobs as json lines over a localhost socket and
+		receive json lines back: "queued", then "progress" for sweeps, then "done" with the result or "error".
+		Grover jobs of the same register size that arrive within batch_window seconds of each other share
+		one GroverBatch evolution. Jobs run on a shared pool of worker processes.
+		host = address to listen on, localhost by default (str)
+		port = port to listen on (int)
+		workers = number of worker processes. Defaults to every core (int)
+		batch_window = seconds to wait for more Grover jobs to batch with the first (float)
+		max_batch = maximum number of Grover jobs evolved together (int)
+		max_bits = largest register accepted for Grover jobs, as their dense operators grow as 4^bits (int)
+		"""
+		self.host = host if host != None else HOST
+		self.port = port if port != None else PORT
+		self.workers = workers if workers != None else os.cpu_count()
+		self.batch_window = batch_window if batch_window != None else 0.05
+		self.max_batch = max_batch if max_batch != None else 256
+		self.max_bits = max_bits if max_bits != None else 12
+		self.ids = itertools.count()
+		self.grover_queue = None
+		self.pool = None
+
+	async def serve(self):
+		"""
+		Runs the service until it is cancelled.
+		"""
+		self.grover_queue = asyncio.Queue()
+		self.pool = concurrent.futures.ProcessPoolExecutor(self.workers,mp_context=multiprocessing.get_context("spawn"))
+		batcher = asyncio.create_task(self.grover_batcher())
+		server = await asyncio.start_server(self.handle,self.host,self.port)
+		print("Serving simulation jobs on {}:{}".format(self.host,self.port))
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			batcher.cancel()
+			self.pool.shutdown(cancel_futures=True)
+
+	async def handle(self,reader,writer):
+		"""
+		Reads the jobs of one client connection, running each as it arrives.
+		"""
+		lock = asyncio.Lock()
+		async def send(message):
+			async with lock:
+				writer.write((json.dumps(message,default=sweep.to_json)+"\n").encode("utf-8"))
+				await writer.drain()
+		tasks = []
+		while True:
+			line = await reader.readline()
+			if not line:
+				break
+			try:
+				job = json.loads(line)
+			except json.JSONDecodeError as error:
+				await send({"status":"error","error":"Invalid job: {}".format(error)})
+				continue
+			job["id"] = job.get("id",next(self.ids))
+			await send({"id":job["id"],"status":"queued"})
+			tasks.append(asyncio.create_task(self.run_job(job,send)))
+		await asyncio.gather(*tasks,return_exceptions=True)
+		writer.close()
+
+	async def run_job(self,job,send):
+		try:
+			if job.get("type") == "grover":
+				result = await self.run_grover(job)
+			elif job.get("type") == "shor":
+				arguments = {key:job[key] for key in ("a","bits","errorp","error_size","error_model","shots","seed") if key in job}
+				result = await asyncio.get_running_loop().run_in_executor(self.pool,functools.partial(run_shor_job,job["N"],**arguments))
+			elif job.get("type") == "sweep":
+				result = await self.run_sweep(job,send)
+			else:
+				raise ValueError("Unknown job type: {}".format(job.get("type")))
+			await send({"id":job["id"],"status":"done","result":result})
+		except Exception:
+			await send({"id":job["id"],"status":"error","error":traceback.format_exc()})
+
+	def check_grover(self,job):
+		"""
+		Checks the fields of a Grover job before it is batched, so that a bad job fails on its own.
+		Returns the register size, marked states and iteration count.
+		"""
+		bits,iterations,marked = job.get("bits"),job.get("iterations"),job.get("marked")
+		if not isinstance(bits,int) or not 1 <= bits <= self.max_bits:
+			raise ValueError("Grover jobs need an integer number of bits between 1 and {}".format(self.max_bits))
+		if not isinstance(iterations,int) or iterations < 0:
+			raise ValueError("Grover jobs need a non-negative integer number of iterations")
+		if not isinstance(marked,list) or not all(isinstance(state,int) and 0 <= state < 2**bits for state in marked):
+			raise ValueError("Marked states must be a list of integers between 0 and {}".format(2**bits-1))
+		if "shots" in job and (not isinstance(job["shots"],int) or job["shots"] < 0):
+			raise ValueError("Shots must be a non-negative integer")
+		return (bits,marked,iterations)
+
+	async def run_grover(self,job):
+		"""
+		Queues a Grover job for the batcher. The job gives bits, the marked states, iterations, and
+		optionally shots and seed. Returns the success probability, with sampled counts if shots are given.
+		"""
+		bits,marked,iterations = self.check_grover(job)
+		future = asyncio.get_running_loop().create_future()
+		await self.grover_queue.put(((bits,marked,iterations),future))
+		distribution = await future
+		result = {"probability":float(np.sum(distribution[np.unique(np.asarray(marked,dtype=int))]))}
+		if "shots" in job:
+			counts = np.random.default_rng(job.get("seed")).multinomial(job["shots"],distribution/np.sum(distribution))
+			result["counts"] = {int(state):int(counts[state]) for state in np.flatnonzero(counts)}
+		else:
+			result["distribution"] = distribution.tolist()
+		return result
+
+	async def grover_batcher(self):
+		"""
+		Collects the Grover jobs that arrive together and evolves those of each register size as one batch.
+		A failed batch fails only the jobs in it, and the batcher carries on.
+		"""
+		loop = asyncio.get_running_loop()
+		while True:
+			waiting = [await self.grover_queue.get()]
+			await asyncio.sleep(self.batch_window)
+			while not self.grover_queue.empty():
+				waiting.append(self.grover_queue.get_nowait())
+			groups = {}
+			for (bits,marked,iterations),future in waiting:
+				groups.setdefault(bits,[]).append((marked,iterations,future))
+			for bits,group in groups.items():
+				for start in range(0,len(group),self.max_batch):
+					batch = [(marked,iterations,future) for marked,iterations,future in group[start:start+self.max_batch] if not future.done()]
+					if not batch:	# Every client of the batch has gone
+						continue
+					try:
+						distributions = await loop.run_in_executor(self.pool,run_grover_batch,bits,
+							[marked for marked,iterations,future in batch],[iterations for marked,iterations,future in batch])
+					except Exception as error:
+						for marked,iterations,future in batch:
+							if not future.done():
+								future.set_exception(error)
+						continue
+					for row,(marked,iterations,future) in enumerate(batch):
+						if not future.done():
+							future.set_result(distributions[row])
+
+	async def run_sweep(self,job,send):
+		"""
+		Runs a sweep of one of SHOT_FUNCTIONS over a grid, streaming progress. The job gives the function,
+		fixed parameters, grid, shots, trials, and optionally seed. Its work units run on the shared worker pool.
+		"""
+		if job["function"] not in SHOT_FUNCTIONS:
+			raise ValueError("Unknown shot function: {}".format(job["function"]))
+		loop = asyncio.get_running_loop()
+		progress = lambda done,total: asyncio.run_coroutine_threadsafe(send({"id":job["id"],"status":"progress","done":done,"total":total}),loop)
+		shot = functools.partial(SHOT_FUNCTIONS[job["function"]],**job.get("fixed",{}))
+		run = functools.partial(sweep.run_sweep,shot,job["grid"],job["shots"],job["trials"],
+			seed=job.get("seed"),progress=progress,pool=self.pool,verbose=False)
+		y,errors = await loop.run_in_executor(None,run)	# Only collects results, the units run on self.pool
+		return {"y":y.tolist(),"errors":errors.tolist()}
+
+def submit(job,host=None,port=None):
+	"""
+	Sends a job to a running JobServer and yields every message about it until it is done or fails.
+	job = the job (dict)
+	"""
+	host = host if host != None else HOST
+	port = port if port != None else PORT
+	with socket.create_connection((host,port)) as connection:
+		connection.sendall((json.dumps(job,default=sweep.to_json)+"\n").encode("utf-8"))
+		for line in connection.makefile("r",encoding="utf-8"):
+			message = json.loads(line)
+			yield message
+			if message["status"] in ("done","error"):
+				break
+
+def main():
+	port = int(sys.argv[1]) if len(sys.argv) > 1 else None
+	asyncio.run(JobServer(port=port).serve())
+
+if __name__=="__main__":
+	main()
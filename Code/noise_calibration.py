@@ -0,0 +1,101 @@
+import numpy as np
+import csv
+import quantum_backend as quantum
+import noise_model
+
+def read_counts(filename=None):
+	"""
+	Reads measured bitstring probabilities, such as those recorded from an IBMQ device.
+	Returns the probability of every register state, indexed by the integer value of its bitstring.
+	filename = name of a .csv file with Bitstring,Probability columns (str)
+	"""
+	if filename is None:
+		raise SyntaxError("Counts file not specified")
+	with open(filename,newline="") as file:
+		rows = [row for row in csv.reader(file,delimiter=",")][1:]	# Skip the Bitstring,Probability line
+	bits = len(rows[0][0])
+	probabilities = np.zeros(2**bits)
+	for bitstring,probability in rows:
+		probabilities[int(bitstring,2)] += float(probability)
+	return probabilities/np.sum(probabilities)
+
+def get_distance(measured,simulated,metric=None):
+	"""
+	Distance between two outcome distributions.
+	metric = "tv" for total variation distance or "kl" for the Kullback-Leibler divergence of simulated from measured (str)
+	"""
+	metric = metric if metric != None else "tv"
+	if metric == "tv":
+		return 0.5*float(np.sum(np.abs(measured-simulated)))
+	elif metric == "kl":
+		simulated = np.clip(simulated,1e-12,None)	# Unseen outcomes would otherwise give an infinite divergence
+		nonzero = measured > 0
+		return float(np.sum(measured[nonzero]*np.log(measured[nonzero]/simulated[nonzero])))
+	raise ValueError("Unknown metric: {}".format(metric))
+
+def simulate_distribution(grover,iterations,errorp,error_size,trajectories,seed=None,error_model=None):
+	"""
+	Mean outcome distribution of a noisy Grover search over many trajectories. All trajectories are
+	sampled in one draw, and the same seed is used at every grid point so that neighbouring points share
+	their random numbers and compare fairly.
+	"""
+	noise = noise_model.NoiseModel(errorp,error_size=error_size,error_model=error_model,seed=seed)
+	noise.presample(grover.bitnumber,3*iterations,trajectories)
+	distribution = np.zeros(2**grover.bitnumber)
+	for i in range(trajectories):
+		distribution += np.abs(grover.search(iterations,noise=noise))**2
+	return distribution/trajectories
+
+def fit_noise(measured,iterations,target=None,errorp_list=None,error_size_list=None,metric=None,
+		coarse_trajectories=None,fine_trajectories=None,keep=None,refinements=None,seed=None,error_model=None,verbose=None):
+	"""
+	Finds the noise parameters whose simulated Grover search best reproduces a measured distribution.
+	Every point of a coarse (errorp, error_size) grid is scored with a few trajectories, only the best
+	fraction are re-scored with more, and the grid is then refined around the best point.
+	Returns (errorp, error_size, distance).
+	measured = measured probability of every register state (numpy array)
+	iterations = number of Grover iterations run on the device (int)
+	target = marked state. If not specified, the most frequently measured state is used (int)
+	keep = fraction of the coarse grid that is re-scored with fine_trajectories (float)
+	refinements = number of times the grid is refined around the best point (int)
+	"""
+	bits = int(np.log2(len(measured)))
+	target = target if target != None else int(np.argmax(measured))
+	errorp_list = errorp_list if errorp_list != None else list(np.linspace(0,1,6))
+	error_size_list = error_size_list if error_size_list != None else list(np.linspace(0,0.5,6))
+	coarse_trajectories = coarse_trajectories if coarse_trajectories != None else 16
+	fine_trajectories = fine_trajectories if fine_trajectories != None else 128
+	keep = keep if keep != None else 0.25
+	refinements = refinements if refinements != None else 2
+	seed = seed if seed != None else 0	# Common random numbers across the grid need a fixed seed
+	verbose = verbose if verbose != None else False
+
+	J = quantum.Grover(lambda x: x == target,bits)
+	score = lambda point,trajectories: get_distance(measured,simulate_distribution(J,iterations,point[0],point[1],trajectories,seed=seed,error_model=error_model),metric=metric)
+
+	points = [(errorp,error_size) for errorp in errorp_list for error_size in error_size_list]
+	errorp_step = (max(errorp_list)-min(errorp_list))/max(len(errorp_list)-1,1)
+	error_size_step = (max(error_size_list)-min(error_size_list))/max(len(error_size_list)-1,1)
+	scores = {}	# Fine scores of every point that survived pruning
+	for refinement in range(refinements+1):
+		points = [point for point in points if point not in scores]
+		coarse = sorted(points,key=lambda point: score(point,coarse_trajectories))
+		survivors = coarse[:max(1,int(np.ceil(keep*len(coarse))))]	# Prune the clearly bad points early
+		for point in survivors:
+			scores[point] = score(point,fine_trajectories)
+		best = min(scores,key=scores.get)
+		if verbose: print("Refinement {}/{}: errorp={:.4f}, error_size={:.4f}, distance={:.4f}".format(refinement,refinements,best[0],best[1],scores[best]))
+		errorp_step,error_size_step = errorp_step/2,error_size_step/2
+		points = [(min(max(best[0]+i*errorp_step,0),1),max(best[1]+j*error_size_step,0)) for i in (-1,0,1) for j in (-1,0,1)]
+		points = list(dict.fromkeys(points))	# Clipping at the edges of the grid can repeat points
+	return (best[0],best[1],scores[best])
+
+def main():
+	measured = read_counts("../Random Stuff/20230220-IBMQ-Manila-Data.csv")
+	bits = int(np.log2(len(measured)))
+	iterations = int(np.ceil(np.sqrt(2**bits)))	# As run on the device
+	errorp,error_size,distance = fit_noise(measured,iterations,verbose=True)
+	print("Best fit: errorp = {:.4f}, error_size = {:.4f}, total variation distance = {:.4f}".format(errorp,error_size,distance))
+
+if __name__=="__main__":
+	main()
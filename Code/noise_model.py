@@ -0,0 +1,212 @@
+import numpy as np
+import math
+
+# One record per error gate: which circuit of the batch, which error location, which qubit, and the gate itself.
+# pauli is 0 for a rotation by angle about axis, otherwise 1, 2, 3 for X, Y, Z
+SCHEDULE_DTYPE = np.dtype([("circuit","i4"),("location","i4"),("qubit","i2"),("pauli","i1"),("axis","f8",(3,)),("angle","f8")])
+PAULI_CHANNELS = {"bit_flip":1,"phase_flip":3}
+
+def apply_unary(state,gate,target,bits,xp=None):
+	"""
+	Applies a unary gate to one qubit of a state vector without extending it to the full register.
+	state = state vector (numpy or cupy array)
+	gate = unary gate (2D array, size 2*2)
+	target = index of the qubit the gate is applied to. Indexing of qubits starts from ZERO! (int)
+	bits = number of qubits (int)
+	xp = array module of the state, numpy or cupy (module)
+	"""
+	xp = xp if xp != None else np
+	state = state.reshape([2]*bits)
+	state = xp.tensordot(xp.asarray(gate),state,axes=([1],[target]))	# Contracted axis moves to the front
+	return xp.moveaxis(state,0,target).reshape(-1)
+
+def apply_gates(state,gates,bits,xp=None):
+	"""
+	Applies the error gates of one error location, as given by a schedule, to a state vector.
+	state = state vector (numpy or cupy array)
+	gates = schedule records of this error location (structured numpy array, SCHEDULE_DTYPE)
+	bits = number of qubits (int)
+	xp = array module of the state, numpy or cupy (module)
+	"""
+	xp = xp if xp != None else np
+	indices = xp.arange(2**bits)
+	for gate in gates:
+		target = int(gate["qubit"])
+		if gate["pauli"] == 0:
+			n_x,n_y,n_z = gate["axis"]
+			half_angle = gate["angle"]/2
+			matrix = np.cos(half_angle)*np.identity(2)-1j*np.sin(half_angle)*np.array([[n_z,n_x-1j*n_y],[n_x+1j*n_y,-n_z]])
+			state = apply_unary(state,matrix,target,bits,xp=xp)
+			continue
+		mask = 1 << (bits-1-target)	# Qubit 0 is the most significant bit, as in extend_unary
+		if gate["pauli"] in (2,3):
+			state = state*xp.where(indices & mask,-1,1)
+		if gate["pauli"] in (1,2):
+			state = state[indices ^ mask]
+	return state
+
+class NoiseModel:
+
+	def __init__(self,errorp,error_size=None,error_model=None,seed=None):
+		"""
+		Describes the errors of a noisy circuit, and samples every error event of one or many circuits
+		in a single vectorised draw. The sampled schedule can be saved and loaded for exact replay.
+		errorp = probability of an error at each error location, and on each additional qubit (float)
+		error_size = size of the rotation errors, angles are drawn between 0 and 4*pi*error_size (float)
+		error_model = "rotation", "bit_flip", "phase_flip" or "depolarising" (str)
+		seed = seed for the random number generator (int)
+		"""
+		self.errorp = errorp
+		self.error_size = error_size if error_size != None else 0.1
+		self.error_model = error_model if error_model != None else "rotation"
+		if self.error_model not in ("rotation","depolarising") and self.error_model not in PAULI_CHANNELS:
+			raise ValueError("Unknown error model: {}".format(self.error_model))
+		self.rng = np.random.default_rng(seed)
+		self.schedule = None
+		self.shape = None	# (circuits, locations, bits) of the pre-sampled schedule
+		self.cursor = 0		# Next pre-sampled circuit to hand out
+
+	def sample_schedule(self,bits,locations,circuits=None,fired=None):
+		"""
+		Samples the error events of a batch of circuits. Returns a schedule with one record per error gate.
+		bits = number of qubits (int)
+		locations = number of error locations in each circuit (int)
+		circuits = number of circuits in the batch (int)
+		fired = which error locations fire, instead of sampling them (2D boolean numpy array, size circuits*locations)
+		"""
+		circuits = circuits if circuits != None else 1
+		shape = (circuits,locations)
+		if fired is None:
+			fired = self.rng.random(shape) <= self.errorp
+		fired = np.broadcast_to(np.asarray(fired,dtype=bool),shape)
+		# One random target per location, plus every other qubit with probability errorp
+		targets = self.rng.random(shape+(bits,)) <= self.errorp
+		forced = self.rng.integers(0,bits,shape)
+		np.put_along_axis(targets,forced[...,None],True,axis=2)
+		if self.error_model == "rotation":
+			axes = self.rng.random(shape+(bits,3))*self.rng.choice([-1,1],size=shape+(bits,3))
+			axes /= np.linalg.norm(axes,axis=3,keepdims=True)
+			angles = (4*np.pi*self.error_size)*self.rng.random(shape+(bits,))
+			paulis = np.zeros(shape+(bits,),dtype=np.int8)
+		else:
+			axes = np.zeros(shape+(bits,3))
+			angles = np.zeros(shape+(bits,))
+			if self.error_model == "depolarising":
+				paulis = self.rng.integers(1,4,shape+(bits,),dtype=np.int8)
+			else:
+				paulis = np.full(shape+(bits,),PAULI_CHANNELS[self.error_model],dtype=np.int8)
+
+		circuit,location,qubit = np.nonzero(fired[...,None] & targets)
+		schedule = np.empty(len(circuit),dtype=SCHEDULE_DTYPE)
+		schedule["circuit"] = circuit
+		schedule["location"] = location
+		schedule["qubit"] = qubit
+		schedule["pauli"] = paulis[circuit,location,qubit]
+		schedule["axis"] = axes[circuit,location,qubit]
+		schedule["angle"] = angles[circuit,location,qubit]
+		return schedule
+
+	def presample(self,bits,locations,circuits):
+		"""
+		Samples the schedule of many circuits at once. They are handed out in order by next_schedule.
+		"""
+		self.schedule = self.sample_schedule(bits,locations,circuits=circuits)
+		self.shape = (circuits,locations,bits)
+		self.cursor = 0
+
+	def next_schedule(self,bits,locations):
+		"""
+		Returns the schedule of the next circuit, using the pre-sampled schedule while it lasts.
+		bits = number of qubits (int)
+		locations = number of error locations in the circuit (int)
+		"""
+		if self.schedule is None or self.cursor >= self.shape[0]:
+			return self.sample_schedule(bits,locations)
+		if self.shape[1:] != (locations,bits):
+			raise ValueError("Pre-sampled schedule is for {} locations on {} qubits".format(self.shape[1],self.shape[2]))
+		start,stop = np.searchsorted(self.schedule["circuit"],[self.cursor,self.cursor+1])
+		self.cursor += 1
+		return self.schedule[start:stop]
+
+	def save(self,filename):
+		"""
+		Saves the pre-sampled schedule and the model parameters to a .npz file.
+		"""
+		np.savez(filename,schedule=self.schedule,shape=np.array(self.shape),errorp=self.errorp,
+			error_size=self.error_size,error_model=self.error_model)
+
+	@classmethod
+	def load(cls,filename):
+		"""
+		Loads a saved schedule, which is then replayed circuit by circuit.
+		"""
+		with np.load(filename) as data:
+			model = cls(float(data["errorp"]),error_size=float(data["error_size"]),error_model=str(data["error_model"]))
+			model.schedule = data["schedule"]
+			model.shape = tuple(int(i) for i in data["shape"])
+		return model
+
+
+def stratified_success(trajectory_success,locations,errorp,trajectories,error_size=None,error_model=None,seed=None,z=None):
+	"""
+	Estimates the success probability of a noisy circuit by stratifying on the number of error events.
+	Each stratum is weighted by its exact binomial probability, and the trajectories inside a stratum
+	contribute their exact success probability instead of a sampled measurement. The error-free
+	stratum is a single deterministic trajectory. Strata too unlikely to be given two trajectories could
+	have any success probability, so they enter the estimate at half their weight and widen the interval
+	by half their weight on either side. Returns (estimate, (lower, upper) confidence bounds).
+	trajectory_success = function taking (noise, fired) and returning the exact success probability of
+	    the trajectory in which the error locations flagged by fired fire (function)
+	locations = number of error locations in the circuit (int)
+	errorp = probability of an error at each error location (float)
+	trajectories = total number of noisy trajectories to simulate (int)
+	z = number of standard errors spanned by the confidence interval. Defaults to 1.96 (float)
+	"""
+	z = z if z != None else 1.96
+	rng = np.random.default_rng(seed)
+	noise = NoiseModel(errorp,error_size=error_size,error_model=error_model,seed=rng)
+	weights = np.array([math.comb(locations,k)*errorp**k*(1-errorp)**(locations-k) for k in range(locations+1)])
+	estimate = weights[0]*trajectory_success(noise,np.zeros(locations,dtype=bool))
+	variance = 0
+	sampled = weights[0]	# Probability mass of the strata whose success probability is estimated
+	noisy_mass = 1-weights[0]
+	for k in range(1,locations+1):
+		samples = int(np.round(trajectories*weights[k]/noisy_mass)) if noisy_mass > 0 else 0
+		if samples < 2:
+			continue
+		results = []
+		for i in range(samples):
+			fired = np.zeros(locations,dtype=bool)
+			fired[rng.choice(locations,size=k,replace=False)] = True
+			results.append(trajectory_success(noise,fired))
+		estimate += weights[k]*np.mean(results)
+		variance += weights[k]**2*np.var(results,ddof=1)/samples
+		sampled += weights[k]
+	tail = max(1-sampled,0)	# Mass of the unsampled strata, whose success probability lies anywhere in [0,1]
+	estimate += tail/2
+	halfwidth = z*np.sqrt(variance)+tail/2
+	return (float(estimate),(float(max(estimate-halfwidth,0)),float(min(estimate+halfwidth,1))))
+
+def crn_success_curve(trajectory_success,locations,errorp_list,trajectories,error_size=None,error_model=None,seed=None,z=None):
+	"""
+	Estimates the success probability at every error probability in errorp_list using common random
+	numbers. Trajectory t draws the same uniform numbers at every errorp, so an error that fires at
+	one errorp also fires at every larger one and neighbouring points are strongly correlated.
+	Returns (estimates, lower bounds, upper bounds) as numpy arrays.
+	trajectory_success = function taking (noise, fired) and returning the exact success probability (function)
+	locations = number of error locations in the circuit (int)
+	errorp_list = error probabilities to estimate the success probability at (list)
+	trajectories = number of noisy trajectories per error probability (int)
+	z = number of standard errors spanned by the confidence interval. Defaults to 1.96 (float)
+	"""
+	z = z if z != None else 1.96
+	seeds = np.random.SeedSequence(seed).spawn(trajectories)
+	uniforms = np.random.default_rng(seed).random((trajectories,locations))
+	results = np.empty((len(errorp_list),trajectories))
+	for i,errorp in enumerate(errorp_list):
+		for t in range(trajectories):
+			noise = NoiseModel(errorp,error_size=error_size,error_model=error_model,seed=seeds[t])	# Same gate draws at every errorp
+			results[i,t] = trajectory_success(noise,uniforms[t] <= errorp)
+	estimates = np.mean(results,axis=1)
+	halfwidths = z*np.std(results,axis=1,ddof=1)/np.sqrt(trajectories)
+	return (estimates,np.clip(estimates-halfwidths,0,1),np.clip(estimates+halfwidths,0,1))
@@ -0,0 +1,111 @@
+import numpy as np
+import multiprocessing, os, queue, traceback
+
+def simulation_worker(simulate,jobs,intermediate,results):
+	"""
+	Runs simulations until it reads the end marker, pushing each output to the bounded intermediate
+	queue. Blocks while that queue is full, so simulation never runs far ahead of post-processing.
+	Reports to the results queue when it has finished, so that a worker that exits early can be told apart.
+	"""
+	while True:
+		job = jobs.get()
+		if job is None:
+			break
+		index,arguments,seed = job
+		try:
+			output = simulate(*arguments,rng=np.random.default_rng(seed))
+		except Exception:
+			output = RuntimeError(traceback.format_exc())
+		intermediate.put((index,output))
+	results.put((None,None))
+
+def postprocessing_worker(postprocess,intermediate,results):
+	"""
+	Post-processes simulation outputs until it reads the end marker, pushing each result to the results queue.
+	"""
+	while True:
+		item = intermediate.get()
+		if item is None:
+			break
+		index,output = item
+		if not isinstance(output,Exception):
+			try:
+				output = postprocess(output)
+			except Exception:
+				output = RuntimeError(traceback.format_exc())
+		results.put((index,output))
+
+def run_pipeline(simulate,postprocess,jobs,simulators=None,postprocessors=None,queue_size=None,seed=None,poll=None,verbose=None):
+	"""
+	Runs quantum simulations and their classical post-processing concurrently in separate processes,
+	yielding the results in the order of the jobs as they become available.
+	Simulation workers push their outputs into a bounded queue that post-processing workers consume,
+	so the slower stage sets the pace without either stage waiting for the other shot by shot.
+	simulate = function taking the arguments of a job and a random number generator rng (function)
+	postprocess = function taking the output of simulate and returning the result of the job (function)
+	jobs = arguments of each job (list of tuples)
+	simulators = number of simulation processes. Defaults to all but one core (int)
+	postprocessors = number of post-processing processes (int)
+	queue_size = maximum number of simulation outputs waiting to be post-processed (int)
+	seed = seed of the random number generators, one spawned for each job (int)
+	poll = seconds between checks that every worker is still alive while waiting for a result (float)
+	Both functions must be defined at module level so the workers can import them.
+	Raises RuntimeError if a worker dies, for example killed for running out of memory, instead of waiting forever.
+	"""
+	simulators = simulators if simulators != None else max(1,os.cpu_count()-1)
+	postprocessors = postprocessors if postprocessors != None else 1
+	queue_size = queue_size if queue_size != None else 4*simulators
+	verbose = verbose if verbose != None else False
+	poll = poll if poll != None else 1
+	seeds = np.random.SeedSequence(seed).spawn(len(jobs))
+
+	context = multiprocessing.get_context("spawn")
+	job_queue = context.Queue()
+	intermediate = context.Queue(maxsize=queue_size)
+	results = context.Queue()
+	for index,arguments in enumerate(jobs):
+		job_queue.put((index,tuple(arguments),seeds[index]))
+	for i in range(simulators):
+		job_queue.put(None)
+	workers = [context.Process(target=simulation_worker,args=(simulate,job_queue,intermediate,results)) for i in range(simulators)]
+	workers += [context.Process(target=postprocessing_worker,args=(postprocess,intermediate,results)) for i in range(postprocessors)]
+	for worker in workers:
+		worker.start()
+
+	waiting = {}	# Results that arrived ahead of an earlier job
+	reported = 0	# Simulation workers that have finished all their jobs
+	unreported = 0	# Polls in a row finding a simulation worker that exited without finishing
+	try:
+		for index in range(len(jobs)):
+			while index not in waiting:
+				try:
+					finished,result = results.get(timeout=poll)
+				except queue.Empty:
+					for worker in workers:
+						if worker.exitcode not in (None,0):
+							raise RuntimeError("Pipeline worker {} died with exit code {}".format(worker.name,worker.exitcode))
+					if any(worker.exitcode == 0 for worker in workers[simulators:]):
+						raise RuntimeError("A post-processing worker exited before the end of the pipeline")
+					exited = sum(worker.exitcode == 0 for worker in workers[:simulators])
+					unreported = unreported+1 if exited > reported else 0
+					if unreported > 1:	# Its report would have arrived by now
+						raise RuntimeError("A simulation worker exited without finishing its jobs")
+					continue
+				if finished is None:
+					reported += 1
+					continue
+				waiting[finished] = result
+			result = waiting.pop(index)
+			if isinstance(result,Exception):
+				raise result
+			if verbose: print("Completed {}/{} jobs".format(index+1,len(jobs)),end="\r",flush=True)
+			yield result
+		if verbose: print("\nDone!")
+		for i in range(postprocessors):
+			intermediate.put(None)
+		for worker in workers:
+			worker.join()
+	finally:
+		for worker in workers:
+			if worker.is_alive():
+				worker.terminate()
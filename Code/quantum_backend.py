@@ -1,24 +1,74 @@
 import numpy as np
 import random
+from collections import OrderedDict
+import noise_model
+import shared_arrays
 
-def measure(inputq=None):
+def get_rng(rng=None):
+	"""
+	Random number generator to draw from. If none is given, a new generator is seeded from the global
+	random module, so code that only seeds random stays reproducible.
+	rng = random number generator (numpy Generator)
+	"""
+	return rng if rng is not None else np.random.default_rng(random.getrandbits(64))
+
+def measure(inputq=None,rng=None):
 	"""
 	Measures the N qubit register, simulating quantum randomness.
 	Uses algorithm given in the PHYS379 Quantum Computer project notes.
 	inputq = state vector to be measured (Numpy Array)
+	rng = random number generator, see get_rng (numpy Generator)
 	"""
 	if inputq is None:
 		raise SyntaxError("Qubit state vector to measure not specified!")
 	q = 0
-	r = random.random() # Random number between 0 and 1
+	r = get_rng(rng).random() # Random number between 0 and 1
 	qbitnum = int(np.log2(len(inputq))) # Number of qubits
 
 	for i,state_component in enumerate(inputq):
-		q += state_component**2 # Adds value to existing q
+		q += np.abs(state_component)**2 # Adds value to existing q
 		if q > r:
 			return i # Returns the measured bit state in its decimal representation
 	return len(inputq)-1	# Necessary due to floating point imprecision for large qubit counts
 
+def measure_batch(inputq=None,rng=None):
+	"""
+	Measures a batch of N qubit registers at once, one measurement per row.
+	inputq = stack of state vectors to be measured, one per row (2D numpy array)
+	rng = random number generator, see get_rng (numpy Generator)
+	"""
+	if inputq is None:
+		raise SyntaxError("Qubit state vectors to measure not specified!")
+	r = get_rng(rng).random(len(inputq))	# Random numbers between 0 and 1
+	cumulative = np.cumsum(np.abs(inputq)**2,axis=1)
+	outcomes = np.argmax(cumulative > r[:,None],axis=1)
+	outcomes[cumulative[:,-1] <= r] = inputq.shape[1]-1	# Necessary due to floating point imprecision
+	return outcomes
+
+def marginal(state=None,qubits=None,probabilities=None):
+	"""
+	Exact probability distribution of a subset of the qubits, summing |amplitude|^2 over all the others.
+	The first listed qubit is the most significant bit of the returned index.
+	state = state vector, or a stack of them with the register along the last axis (numpy array)
+	qubits = indices of the qubits to keep. Indexing of qubits starts from ZERO! (int list)
+	probabilities = state already holds probabilities rather than amplitudes (bool)
+	"""
+	if state is None:
+		raise SyntaxError("State vector not specified!")
+	if qubits is None:
+		raise SyntaxError("Qubits to keep not specified")
+	probabilities = probabilities if probabilities != None else False
+	state = np.asarray(state)
+	bits = int(np.log2(state.shape[-1]))
+	batch = state.shape[:-1]
+	table = state if probabilities else np.abs(state)**2
+	table = table.reshape(batch+(2,)*bits)
+	others = tuple(len(batch)+i for i in range(bits) if i not in qubits)
+	table = np.sum(table,axis=others)	# Remaining qubit axes are in ascending order
+	kept = sorted(qubits)
+	table = np.transpose(table,tuple(range(len(batch)))+tuple(len(batch)+kept.index(q) for q in qubits))
+	return table.reshape(batch+(2**len(qubits),))
+
 def extend_unary(targets=None,gate=None,bits=None,verbose=None):
 	"""
 	Extend unary gate to an N qubit state. If no target is supplied then the gate is applied to all qubits.
@@ -49,8 +99,33 @@ def extend_unary(targets=None,gate=None,bits=None,verbose=None):
 	return temp_gate
 
 
-def get_error_matrix(bits,errorp):
+def compute_hadamards(bits,verbose=None):
+	"""
+	Hadamard gate on every one of bits qubits, which maps |0> to the equal superposition |s>.
+	"""
+	verbose = verbose if verbose != None else False
+	if verbose: print("Computing Hadamard Network...")
+	hadamard_gate = 1/(np.sqrt(2))*np.array([[1,1],[1,-1]],dtype=np.float32)
+	hadamards = extend_unary(gate=hadamard_gate,bits=bits,verbose=verbose)
+	if verbose: print("Done!")
+	return hadamards
+
+def compute_diffuser(hadamards,verbose=None):
+	"""
+	Grover diffuser 2|s><s|-I, built from the Hadamard network of the register.
+	"""
+	verbose = verbose if verbose != None else False
+	if verbose: print("Computing Diffuser...")
+	diffuser = -1*np.identity(len(hadamards),dtype=np.float32)
+	diffuser[0,0] = 1
+	diffuser = np.matmul(hadamards,diffuser)
+	diffuser = np.matmul(diffuser,hadamards)
+	if verbose: print("Done!")
+	return diffuser
+
+def get_error_matrix(bits,errorp,rng=None):
 	error_size = 0.01
+	rng = get_rng(rng)
 	# Define generators of U(2) and the identity matrix
 	X = np.array([[0,1],[1,0]])
 	Y = np.array([[0,-1j],[1j,0]])
@@ -58,20 +133,20 @@ def get_error_matrix(bits,errorp):
 	I = np.array([[1,0],[0,1]])
 
 	# Create a list of targets to apply random error "gates" to
-	targets = [[random.randint(0,bits-1)]]
+	targets = [[int(rng.integers(0,bits))]]
 	for i in range(bits):
 		if i in targets:
 			continue
-		elif random.random() <= errorp:
+		elif rng.random() <= errorp:
 			targets.append([i])
 	
 	matrices = []
 	for target in targets:
-		n_vec = np.random.rand(3)	# Create randomised axis vector for the gate
+		n_vec = rng.random(3)	# Create randomised axis vector for the gate
 		for i,component in enumerate(n_vec):
-			n_vec[i] = component*((-1)**random.randint(0,1))	# Flip sign of components at random
+			n_vec[i] = component*((-1)**rng.integers(0,2))	# Flip sign of components at random
 		n_vec = n_vec/np.linalg.norm(n_vec)		# Ensure the axis vector is normalised
-		angle = (4*np.pi*error_size)*random.random()	# Pick a random angle between 0 and pi/8
+		angle = (4*np.pi*error_size)*rng.random()	# Pick a random angle between 0 and pi/8
 		matrix = np.cos(angle/2)*I-1j*np.sin(angle/2)*(n_vec[0]*X+n_vec[1]*Y+n_vec[2]*Z)	# Construct the gate
 		extended_matrix = extend_unary(targets=target,gate=matrix,bits=bits)	# Extend the gate to the multi-qubit setup
 		matrices.append(extended_matrix)
@@ -82,35 +157,104 @@ def get_error_matrix(bits,errorp):
 		error_matrix = np.matmul(error_matrix,matrix)
 	return error_matrix
 
+def apply_pauli_error(state,bits,errorp,channel=None,rng=None):
+	"""
+	Applies a random Pauli error to a state vector using only index and sign operations.
+	X is an XOR permutation of the basis indices, Z is a sign flip and Y is both.
+	Y is applied as XZ, which differs from Y only by a global phase, so real states stay real.
+	Targets are chosen as in get_error_matrix: one random qubit, plus each other qubit with probability errorp.
+	state = state vector the error acts on (numpy array)
+	bits = number of qubits (int)
+	errorp = probability of an error on each additional qubit (float)
+	channel = "bit_flip" (X), "phase_flip" (Z) or "depolarising" (random X, Y or Z). Defaults to "depolarising" (str)
+	rng = random number generator, see get_rng (numpy Generator)
+	"""
+	channel = channel if channel != None else "depolarising"
+	if channel not in ("bit_flip","phase_flip","depolarising"):
+		raise ValueError("Unknown Pauli channel: {}".format(channel))
+	rng = get_rng(rng)
+	targets = [int(rng.integers(0,bits))]
+	for i in range(bits):
+		if i in targets:
+			continue
+		elif rng.random() <= errorp:
+			targets.append(i)
+
+	indices = np.arange(2**bits)
+	for target in targets:
+		if channel == "bit_flip":
+			pauli = "X"
+		elif channel == "phase_flip":
+			pauli = "Z"
+		else:
+			pauli = "XYZ"[rng.integers(0,3)]
+		mask = 1 << (bits-1-target)	# Qubit 0 is the most significant bit, as in extend_unary
+		if pauli in "YZ":
+			state = state*np.where(indices & mask,-1,1)
+		if pauli in "XY":
+			state = state[indices ^ mask]
+	return state
+
 class Grover:
 
-	def __init__(self, oracle_function, bits, verbose=None):
+	def __init__(self, oracle_function, bits, verbose=None, cache_size=None, operators=None):
+		"""
+		oracle_function = function returning True for marked register states (function)
+		bits = number of qubits (int)
+		cache_size = maximum number of evolved states G^k|s> kept for the current oracle (int)
+		operators = precomputed "hadamards" and "diffuser" of this register size, used instead of computing them.
+		    If not specified, any published to this process as "grover_{bits}/..." through shared_arrays are used (dict)
+		"""
 		if verbose is None:
 			self.verbose = False
 		else:
 			self.verbose = verbose
 		self.bitnumber = bits
+		self.cache_size = cache_size if cache_size != None else 16
+		self.state_cache = OrderedDict()
 
-		if self.verbose: print("Computing Hadamard Network...")
-		hadamard_gate = 1/(np.sqrt(2))*np.array([[1,1],[1,-1]],dtype=np.float32)
-		self.hadamards = extend_unary(gate=hadamard_gate,bits=self.bitnumber,verbose=self.verbose)
-		if self.verbose: print("Done!")
+		operators = operators if operators != None else shared_arrays.get_group("grover_{}".format(bits))
+		if operators != None:
+			self.hadamards = operators["hadamards"]
+			self.diffuser = operators["diffuser"]
+		else:
+			self.hadamards = compute_hadamards(self.bitnumber,verbose=self.verbose)
+			self.diffuser = self.compute_diffuser()
+		self.set_oracle(oracle_function)
 
-		self.diffuser = self.compute_diffuser()
-		self.quantum_oracle = self.compute_oracle(oracle_function)
+	def get_operators(self):
+		"""
+		Returns the operators that depend only on the register size, so they can be shared with other
+		instances, for example through shared_arrays.
+		"""
+		return {"hadamards":self.hadamards,"diffuser":self.diffuser}
 
-	def compute_diffuser(self):
-		if self.verbose: print("Computing Diffuser...")
-		diffuser = -1*np.identity(2**self.bitnumber,dtype=np.float32)
-		diffuser[0,0] = 1
-		diffuser = np.matmul(self.hadamards,diffuser)
-		diffuser = np.matmul(diffuser,self.hadamards)
+	def set_oracle(self,oracle_function):
+		"""
+		Replaces the quantum oracle, invalidating any cached Grover states.
+		oracle_function = function returning True for marked register states, or a mask of them such as
+		    one compiled by catalogue_query (function, or boolean numpy array)
+		"""
+		if isinstance(oracle_function,np.ndarray):
+			mask = oracle_function.astype(bool)
+			oracle_function = lambda x: x < len(mask) and bool(mask[x])
+			self.quantum_oracle = self.compute_oracle(mask)
+		else:
+			self.quantum_oracle = self.compute_oracle(oracle_function)
+		self.oracle_function = oracle_function
+		self.marked = np.diagonal(self.quantum_oracle) < 0	# Mask of the states flagged by the oracle
+		self.state_cache.clear()
 
-		if self.verbose: print("Done!")
-		return diffuser
+	def compute_diffuser(self):
+		return compute_diffuser(self.hadamards,verbose=self.verbose)
 
 	def compute_oracle(self,oracle_function):
 		if self.verbose: print("Computing Quantum Oracle...")
+		if isinstance(oracle_function,np.ndarray):	# A mask marks every state in one step
+			signs = np.ones(2**self.bitnumber,dtype=np.float32)
+			signs[np.flatnonzero(oracle_function[:2**self.bitnumber])] = -1
+			if self.verbose: print("Done!")
+			return np.diag(np.asarray(signs))
 		quantum_oracle = np.identity(2**self.bitnumber,dtype=np.float32)
 		for i in range(2**self.bitnumber):
 			try:	# Use try/except in case the number of bits exceeds original register bitlength
@@ -122,27 +266,255 @@ class Grover:
 		if self.verbose: print("Done!")
 		return quantum_oracle
 
-	def search(self,iterations,errorp=None):
+	def initial_state(self):
+		"""
+		Returns the equal superposition state |s> the search starts from.
+		"""
+		initial = np.zeros(2**self.bitnumber,dtype=np.float32)
+		initial[0] = 1
+		return np.matmul(self.hadamards,initial)
+
+	def evolve(self,iterations):
+		"""
+		Computes G^k|s> for the current oracle without noise, continuing from the largest cached
+		iteration count not exceeding the request. Evolved states are kept in a bounded LRU cache.
+		iterations = the number of iterations k (int)
+		"""
+		if iterations in self.state_cache:
+			self.state_cache.move_to_end(iterations)
+			return self.state_cache[iterations]
+		start = max([k for k in self.state_cache if k < iterations],default=None)
+		if start is None:
+			start, state = 0, self.initial_state()
+		else:
+			state = self.state_cache[start]
+		for i in range(start,iterations):
+			state = np.matmul(self.quantum_oracle,np.matmul(self.diffuser,state))
+			if self.verbose: print("Completed {}/{} Grover Iterations...".format(i+1,iterations), end="\r",flush=True)
+		if self.verbose and iterations > start: print("\nDone!")
+
+		self.state_cache[iterations] = state
+		if len(self.state_cache) > self.cache_size:
+			self.state_cache.popitem(last=False)	# Evict the least recently used state
+		return state
+
+	def iterate(self,iterations=None,probabilities=None):
+		"""
+		Generator yielding the noiseless state after each Grover iteration, starting from |s>.
+		Only the current state is held, so a full success-versus-iterations curve costs one search.
+		iterations = number of iterations to run. If not specified, iterates until the caller stops (int)
+		probabilities = yield only the probability of measuring a marked state instead of the state vector (bool)
+		"""
+		probabilities = probabilities if probabilities != None else False
+		state = self.initial_state()
+		i = 0
+		while iterations is None or i < iterations:
+			state = np.matmul(self.quantum_oracle,np.matmul(self.diffuser,state))
+			i += 1
+			if probabilities:
+				yield float(np.sum(state[self.marked]**2))
+			else:
+				yield state
+
+	def success_probability(self,iterations,noise=None,fired=None):
+		"""
+		Exact probability of measuring a marked state after a search, instead of sampling a measurement.
+		With a noise model this is the success probability of a single noisy trajectory.
+		"""
+		state = self.search(iterations,noise=noise,fired=fired)
+		return float(np.sum(np.abs(state[self.marked])**2))
+
+	def search(self,iterations,errorp=None,error_model=None,noise=None,fired=None,rng=None):
 		"""
 		Performs a Grover Search for a given number of iterations. Returns a numpy array.
+		Noiseless searches are served from the state cache where possible.
+		With errors, the error events are sampled first. If none fire the cached noiseless state is
+		returned, otherwise the cached noiseless state up to the first error event is evolved onwards.
 		Iterations: The number of iterations to compute (int)
+		errorp: Probability of an error at each of the three error locations per iteration (float)
+		error_model: "rotation" for random SU(2) rotations, or a Pauli channel accepted by apply_pauli_error (str)
+		noise: Noise model providing a pre-sampled error schedule, used instead of errorp and error_model (NoiseModel)
+		fired: Error locations that fire, sampling only the error gates from the noise model (boolean numpy array)
+		rng: Random number generator the errors are drawn from, see get_rng (numpy Generator)
 		"""
-		target_state = np.zeros(2**self.bitnumber,dtype=np.float32)
-		target_state[0] = 1
-		target_state = np.matmul(self.hadamards,target_state)
-
-		circuit = np.identity(2**self.bitnumber,dtype=np.float32)
-		for i in range(iterations):
-			if errorp is not None:
-				if random.random() <= errorp: circuit=np.matmul(circuit,get_error_matrix(self.bitnumber,errorp))
-			circuit = np.matmul(circuit,self.quantum_oracle)
-			if errorp is not None:
-				if random.random() <= errorp: circuit=np.matmul(circuit,get_error_matrix(self.bitnumber,errorp))
-			circuit = np.matmul(circuit,self.diffuser)
-			if errorp is not None:
-				if random.random() <= errorp: circuit=np.matmul(circuit,get_error_matrix(self.bitnumber,errorp))
+		if noise is not None:
+			if fired is None:
+				gates = noise.next_schedule(self.bitnumber,3*iterations)
+			else:
+				gates = noise.sample_schedule(self.bitnumber,3*iterations,fired=fired)
+			events = list(np.isin(np.arange(3*iterations),gates["location"]))
+			error = lambda state,location: noise_model.apply_gates(state,gates[gates["location"] == location],self.bitnumber)
+		elif errorp is None:
+			return self.evolve(iterations).copy()
+		else:
+			error_model = error_model if error_model != None else "rotation"
+			rng = get_rng(rng)
+			if error_model == "rotation":
+				error = lambda state,location: np.matmul(get_error_matrix(self.bitnumber,errorp,rng=rng),state)
+			else:
+				error = lambda state,location: apply_pauli_error(state,self.bitnumber,errorp,channel=error_model,rng=rng)
+			events = list(rng.random(3*iterations) <= errorp)	# Error locations around the diffuser and oracle
+
+		if not any(events):
+			return self.evolve(iterations).copy()
+		first_iteration = events.index(True)//3
+		state = self.evolve(first_iteration)
+		for i in range(first_iteration,iterations):
+			if events[3*i]: state = error(state,3*i)
+			state = np.matmul(self.diffuser,state)
+			if events[3*i+1]: state = error(state,3*i+1)
+			state = np.matmul(self.quantum_oracle,state)
+			if events[3*i+2]: state = error(state,3*i+2)
 			if self.verbose: print("Completed {}/{} Grover Iterations...".format(i+1,iterations), end="\r",flush=True)
 		if self.verbose: print("\nDone!")
+		return state
+
+
+class GroverBatch:
+
+	def __init__(self,masks,verbose=None):
+		"""
+		Evolves a batch of Grover searches of the same register size together, sharing the diffuser.
+		masks = marked states of each search, one row per search (2D boolean numpy array, size B*2^n)
+		"""
+		if verbose is None:
+			self.verbose = False
+		else:
+			self.verbose = verbose
+		masks = np.asarray(masks,dtype=bool)
+		self.bitnumber = int(np.log2(masks.shape[1]))
+		self.hadamards = compute_hadamards(self.bitnumber,verbose=self.verbose)
+		self.diffuser = compute_diffuser(self.hadamards,verbose=self.verbose)
+		self.set_oracle(masks)
+
+	@classmethod
+	def from_thresholds(cls,database,thresholds,verbose=None):
+		"""
+		Builds one search per threshold, marking the database entries below it. Empty (None) entries are never marked.
+		database = list of values to search, padded to a power of 2 (list)
+		thresholds = threshold value of each search (list)
+		"""
+		values = np.array([np.nan if entry is None else entry for entry in database],dtype=float)
+		masks = values[None,:] < np.asarray(thresholds,dtype=float)[:,None]
+		return cls(masks,verbose=verbose)
+
+	def set_oracle(self,masks):
+		"""
+		Replaces the marked states of every search in the batch.
+		masks = marked states of each search, one row per search (2D boolean numpy array, size B*2^n)
+		"""
+		self.marked = np.asarray(masks,dtype=bool)
+		self.signs = np.where(self.marked,-1,1).astype(np.float32)	# Diagonal of each oracle
 
-		target = np.matmul(circuit,target_state)
-		return target
\ No newline at end of file
+	def initial_state(self):
+		"""
+		Returns the equal superposition state |s> every search starts from.
+		"""
+		return self.hadamards[:,0].copy()
+
+	def search(self,iterations):
+		"""
+		Performs every Grover Search in the batch without noise. Returns a 2D numpy array with one state per row.
+		iterations = number of iterations, either shared or one per search (int or list)
+		"""
+		iterations = np.broadcast_to(np.asarray(iterations),(len(self.marked),))
+		states = np.tile(self.initial_state(),(len(self.marked),1))
+		for i in range(int(np.max(iterations,initial=0))):
+			evolved = np.matmul(states,self.diffuser.T)*self.signs
+			states = np.where((iterations > i)[:,None],evolved,states)	# Searches that are done keep their state
+			if self.verbose: print("Completed {}/{} Grover Iterations...".format(i+1,np.max(iterations)), end="\r",flush=True)
+		if self.verbose: print("\nDone!")
+		return states
+
+	def iterate(self,iterations=None,probabilities=None):
+		"""
+		Generator yielding the states of the whole batch after each Grover iteration.
+		probabilities = yield only the probability of measuring a marked state in each search (bool)
+		"""
+		probabilities = probabilities if probabilities != None else False
+		states = np.tile(self.initial_state(),(len(self.marked),1))
+		i = 0
+		while iterations is None or i < iterations:
+			states = np.matmul(states,self.diffuser.T)*self.signs
+			i += 1
+			if probabilities:
+				yield np.sum(np.where(self.marked,states**2,0),axis=1)
+			else:
+				yield states
+
+	def distributions(self,iterations):
+		"""
+		Returns the outcome distribution of every search in the batch, one per row.
+		"""
+		return self.search(iterations)**2
+
+
+def bbht_search(grover,scaling=None,max_calls=None,errorp=None,rng=None):
+	"""
+	Searches for a marked state when the number of marked states is unknown, using the exponential
+	search of Boyer, Brassard, Hoyer and Tapp. Returns (measured state or None, oracle calls used).
+	Since D|s>=|s>, search(j+1) performs j effective Grover iterations and is counted as j oracle calls.
+	grover = Grover instance holding the oracle to search (Grover)
+	scaling = growth factor of the maximum iteration count, must lie between 1 and 4/3 (float)
+	max_calls = give up after this many oracle calls. If not specified, this is 9/2*sqrt(N) (int)
+	errorp = error probability passed on to the search (float)
+	rng = random number generator, see get_rng (numpy Generator)
+	"""
+	scaling = scaling if scaling != None else 6/5
+	rng = get_rng(rng)
+	N = 2**grover.bitnumber
+	max_calls = max_calls if max_calls != None else int(np.ceil(4.5*np.sqrt(N)))
+	m = 1
+	calls = 0
+	while calls < max_calls:
+		j = int(rng.integers(0,int(np.ceil(m))))
+		x = measure(grover.search(j+1,errorp=errorp,rng=rng),rng=rng)
+		calls += j
+		if grover.oracle_function(x):
+			return (x,calls)
+		m = min(scaling*m,np.sqrt(N))
+	return (None,calls)
+
+def bbht_expected_calls(bits,marked,scaling=None,max_calls=None):
+	"""
+	Exact expected number of oracle calls made by bbht_search on an ideal quantum computer.
+	Follows the distribution of calls spent over the rounds, so the last round overshooting max_calls
+	is counted as bbht_search counts it.
+	bits = number of qubits (int)
+	marked = number of marked states (int)
+	scaling = growth factor of the maximum iteration count (float)
+	max_calls = oracle call budget of the search (int)
+	"""
+	scaling = scaling if scaling != None else 6/5
+	N = 2**bits
+	max_calls = max_calls if max_calls != None else int(np.ceil(4.5*np.sqrt(N)))
+	theta = np.arcsin(np.sqrt(marked/N))
+	running = np.zeros(max_calls)	# Probability that the search is still running having spent each number of calls
+	running[0] = 1
+	spent = np.arange(max_calls)
+	m = 1
+	expected = 0
+	while np.sum(running) > 1e-12:
+		rounds = int(np.ceil(m))
+		following = np.zeros(max_calls)
+		for j in range(rounds):	# j is drawn uniformly, and search(j+1) finds a marked state with probability sin^2((2j+1)theta)
+			success = np.sin((2*j+1)*theta)**2
+			mass = running/rounds
+			expected += np.sum(mass*(spent+j))*success
+			failed = mass*(1-success)
+			within = max(max_calls-j,0)	# Spent counts that stay inside the budget after this round
+			following[j:] += failed[:within]
+			expected += np.sum(failed[within:]*(spent[within:]+j))	# Out of budget, so the search gives up
+		running = following
+		m = min(scaling*m,np.sqrt(N))
+	return float(expected)
+
+def optimal_iterations(bits,marked):
+	"""
+	Number of iterations to pass to Grover.search that maximises the probability of measuring
+	one of the marked states. Includes the leading iteration whose diffuser leaves |s> unchanged.
+	bits = number of qubits (int)
+	marked = number of marked states, which may be a non-integer estimate (float)
+	"""
+	theta = np.arcsin(np.sqrt(min(max(marked,1),2**bits)/2**bits))
+	return int(np.floor(np.pi/(4*theta)))+1
@@ -1,21 +1,32 @@
 import numpy as np
 import cupy as cp
 import random
+from collections import OrderedDict
+import noise_model
 
-def measure(inputq=None):
+def get_rng(rng=None):
+	"""
+	Random number generator to draw from. If none is given, a new generator is seeded from the global
+	random module, so code that only seeds random stays reproducible.
+	rng = random number generator, drawing on the CPU (numpy Generator)
+	"""
+	return rng if rng is not None else np.random.default_rng(random.getrandbits(64))
+
+def measure(inputq=None,rng=None):
 	"""
 	Measures the N qubit register, simulating quantum randomness.
 	Uses algorithm given in the PHYS379 Quantum Computer project notes.
 	inputq = state vector to be measured (numpy array - Cannot be cupy array!)
+	rng = random number generator, see get_rng (numpy Generator)
 	"""
 	if inputq is None:
 		raise SyntaxError("Qubit state vector to measure not specified!")
 	q = 0
-	r = random.random() # Random number between 0 and 1
+	r = get_rng(rng).random() # Random number between 0 and 1
 	qbitnum = int(np.log2(len(inputq))) # Number of qubits
 
 	for i,state_component in enumerate(inputq):
-		q += state_component**2 # Adds value to existing q
+		q += np.abs(state_component)**2 # Adds value to existing q
 		if q > r:
 			return i # Returns the measured bit state in its decimal representation
 	return len(inputq)-1 # Necessary due to floating point imprecision for large qubit counts
@@ -49,8 +60,9 @@ def extend_unary(targets=None,gate=None,bits=None,verbose=None):
 	if verbose: print()
 	return temp_gate
 
-def get_error_matrix(bits,errorp,error_size=None):
+def get_error_matrix(bits,errorp,error_size=None,rng=None):
 	error_size = error_size if error_size != None else 0.1
+	rng = get_rng(rng)
 	# Define generators of U(2) and the identity matrix
 	X = cp.array([[0,1],[1,0]])
 	Y = cp.array([[0,-1j],[1j,0]])
@@ -59,20 +71,20 @@ def get_error_matrix(bits,errorp,error_size=None):
 
 
 	# Create a list of targets to apply random error "gates" to
-	targets = [[random.randint(0,bits-1)]]
+	targets = [[int(rng.integers(0,bits))]]
 	for i in range(bits):
 		if i in targets:
 			continue
-		elif random.random() <= errorp:
+		elif rng.random() <= errorp:
 			targets.append([i])
 	
 	matrices = []
 	for target in targets:
-		n_vec = cp.random.rand(3)	# Create randomised axis vector for the gate
+		n_vec = cp.asarray(rng.random(3))	# Create randomised axis vector for the gate, drawn on the CPU so the stream matches the numpy backend
 		for i,component in enumerate(n_vec):
-			n_vec[i] = component*((-1)**random.randint(0,1))	# Flip sign of components at random
+			n_vec[i] = component*((-1)**rng.integers(0,2))	# Flip sign of components at random
 		n_vec = n_vec/cp.linalg.norm(n_vec)		# Ensure the axis vector is normalised
-		angle = (4*np.pi*error_size)*random.random()	# Pick a random angle between 0 and pi/8
+		angle = (4*np.pi*error_size)*rng.random()	# Pick a random angle between 0 and pi/8
 		matrix = cp.cos(angle/2)*I-1j*np.sin(angle/2)*(n_vec[0]*X+n_vec[1]*Y+n_vec[2]*Z)	# Construct the gate
 		extended_matrix = extend_unary(targets=target,gate=matrix,bits=bits)	# Extend the gate to the multi-qubit setup
 		matrices.append(extended_matrix)
@@ -83,21 +95,82 @@ def get_error_matrix(bits,errorp,error_size=None):
 		error_matrix = cp.matmul(error_matrix,matrix)
 	return error_matrix
 
+def apply_pauli_error(state,bits,errorp,channel=None,rng=None):
+	"""
+	Applies a random Pauli error to a state vector using only index and sign operations.
+	X is an XOR permutation of the basis indices, Z is a sign flip and Y is both.
+	Y is applied as XZ, which differs from Y only by a global phase, so real states stay real.
+	Targets are chosen as in get_error_matrix: one random qubit, plus each other qubit with probability errorp.
+	state = state vector the error acts on (cupy array)
+	bits = number of qubits (int)
+	errorp = probability of an error on each additional qubit (float)
+	channel = "bit_flip" (X), "phase_flip" (Z) or "depolarising" (random X, Y or Z). Defaults to "depolarising" (str)
+	rng = random number generator, see get_rng (numpy Generator)
+	"""
+	channel = channel if channel != None else "depolarising"
+	if channel not in ("bit_flip","phase_flip","depolarising"):
+		raise ValueError("Unknown Pauli channel: {}".format(channel))
+	rng = get_rng(rng)
+	targets = [int(rng.integers(0,bits))]
+	for i in range(bits):
+		if i in targets:
+			continue
+		elif rng.random() <= errorp:
+			targets.append(i)
+
+	indices = cp.arange(2**bits)
+	for target in targets:
+		if channel == "bit_flip":
+			pauli = "X"
+		elif channel == "phase_flip":
+			pauli = "Z"
+		else:
+			pauli = "XYZ"[rng.integers(0,3)]
+		mask = 1 << (bits-1-target)	# Qubit 0 is the most significant bit, as in extend_unary
+		if pauli in "YZ":
+			state = state*cp.where(indices & mask,-1,1)
+		if pauli in "XY":
+			state = state[indices ^ mask]
+	return state
+
 class Grover:
 
-	def __init__(self,oracle_function,bits,verbose=None):
+	def __init__(self,oracle_function,bits,verbose=None,cache_size=None):
+		"""
+		oracle_function = function returning True for marked register states (function)
+		bits = number of qubits (int)
+		cache_size = maximum number of evolved states G^k|s> kept on the GPU for the current oracle (int)
+		"""
 		if verbose is None:
 			self.verbose = False
 		else:
 			self.verbose = verbose
 		self.bitnumber = bits
+		self.cache_size = cache_size if cache_size != None else 16
+		self.state_cache = OrderedDict()
 		hadamard_gate = 1/(np.sqrt(2))*cp.array([[1,1],[1,-1]],dtype=cp.float32)
 		if self.verbose: print("Computing Hadamard Network...")
 		self.hadamards = extend_unary(gate=hadamard_gate,bits=self.bitnumber,verbose=self.verbose)
 		if self.verbose: print("Done!")
 
 		self.diffuser = self.compute_diffuser()
-		self.quantum_oracle = self.compute_oracle(oracle_function)
+		self.set_oracle(oracle_function)
+
+	def set_oracle(self,oracle_function):
+		"""
+		Replaces the quantum oracle, invalidating any cached Grover states.
+		oracle_function = function returning True for marked register states, or a mask of them such as
+		    one compiled by catalogue_query (function, or boolean numpy array)
+		"""
+		if isinstance(oracle_function,np.ndarray):
+			mask = oracle_function.astype(bool)
+			oracle_function = lambda x: x < len(mask) and bool(mask[x])
+			self.quantum_oracle = self.compute_oracle(mask)
+		else:
+			self.quantum_oracle = self.compute_oracle(oracle_function)
+		self.oracle_function = oracle_function
+		self.marked = cp.diagonal(self.quantum_oracle) < 0	# Mask of the states flagged by the oracle
+		self.state_cache.clear()
 
 	def compute_diffuser(self):
 		if self.verbose: print("Computing Diffuser...")
@@ -111,6 +184,11 @@ class Grover:
 
 	def compute_oracle(self,oracle_function):
 		if self.verbose: print("Computing Quantum Oracle...")
+		if isinstance(oracle_function,np.ndarray):	# A mask marks every state in one step
+			signs = np.ones(2**self.bitnumber,dtype=np.float32)
+			signs[np.flatnonzero(oracle_function[:2**self.bitnumber])] = -1
+			if self.verbose: print("Done!")
+			return cp.diag(cp.asarray(signs))
 		quantum_oracle = cp.identity(2**self.bitnumber,dtype=cp.float32)
 		for i in range(2**self.bitnumber):	# Construct oracle on CPU as looping over elements on the GPU is slow
 			try:	# Use try/except in case the number of bits exceeds original register bitlength
@@ -122,31 +200,110 @@ class Grover:
 		if self.verbose: print("Done!")
 		return quantum_oracle
 
-	def search(self,iterations,errorp=None,error_size=None):
+	def initial_state(self):
+		"""
+		Returns the equal superposition state |s> the search starts from (cupy array).
+		"""
+		initial = cp.zeros(2**self.bitnumber,dtype=cp.float32)
+		initial[0] = 1
+		return cp.matmul(self.hadamards,initial)
+
+	def evolve(self,iterations):
+		"""
+		Computes G^k|s> for the current oracle without noise, continuing from the largest cached
+		iteration count not exceeding the request. Evolved states stay on the GPU in a bounded LRU cache.
+		iterations = the number of iterations k (int)
+		"""
+		if iterations in self.state_cache:
+			self.state_cache.move_to_end(iterations)
+			return self.state_cache[iterations]
+		start = max([k for k in self.state_cache if k < iterations],default=None)
+		if start is None:
+			start, state = 0, self.initial_state()
+		else:
+			state = self.state_cache[start]
+		for i in range(start,iterations):
+			state = cp.matmul(self.quantum_oracle,cp.matmul(self.diffuser,state))
+			if self.verbose: print("Started {}/{} Grover Iterations".format(i+1,iterations),end="\r",flush=True)
+
+		self.state_cache[iterations] = state
+		if len(self.state_cache) > self.cache_size:
+			self.state_cache.popitem(last=False)	# Evict the least recently used state
+		return state
+
+	def iterate(self,iterations=None,probabilities=None):
+		"""
+		Generator yielding the noiseless state after each Grover iteration, starting from |s>.
+		Only the current state is held, so a full success-versus-iterations curve costs one search.
+		iterations = number of iterations to run. If not specified, iterates until the caller stops (int)
+		probabilities = yield only the probability of measuring a marked state instead of the cupy state vector (bool)
+		"""
+		probabilities = probabilities if probabilities != None else False
+		state = self.initial_state()
+		i = 0
+		while iterations is None or i < iterations:
+			state = cp.matmul(self.quantum_oracle,cp.matmul(self.diffuser,state))
+			i += 1
+			if probabilities:
+				yield float(cp.sum(state[self.marked]**2))
+			else:
+				yield state
+
+	def success_probability(self,iterations,noise=None,fired=None):
+		"""
+		Exact probability of measuring a marked state after a search, instead of sampling a measurement.
+		With a noise model this is the success probability of a single noisy trajectory.
+		"""
+		state = self.search(iterations,noise=noise,fired=fired)
+		return float(np.sum(np.abs(state[cp.asnumpy(self.marked)])**2))
+
+	def search(self,iterations,errorp=None,error_size=None,error_model=None,noise=None,fired=None,rng=None):
 		"""
 		Performs a Grover Search for a given number of iterations. Returns a numpy array.
+		Noiseless searches are served from the state cache where possible.
+		With errors, the error events are sampled first. If none fire the cached noiseless state is
+		returned, otherwise the cached noiseless state up to the first error event is evolved onwards.
 		Iterations: The number of iterations to compute (int)
+		errorp: Probability of an error at each of the three error locations per iteration (float)
+		error_model: "rotation" for random SU(2) rotations, or a Pauli channel accepted by apply_pauli_error (str)
+		noise: Noise model providing a pre-sampled error schedule, used instead of errorp and error_model (NoiseModel)
+		fired: Error locations that fire, sampling only the error gates from the noise model (boolean numpy array)
+		rng: Random number generator the errors are drawn from, see get_rng (numpy Generator)
 		"""
-		target_state = cp.zeros(2**self.bitnumber,dtype=cp.float32)
-		target_state[0] = 1
-		target_state = cp.matmul(self.hadamards,target_state)
-
-		circuit = cp.identity(2**self.bitnumber,dtype=cp.float32)
-		for i in range(iterations):
-			if errorp is not None:
-				if random.random() <= errorp: circuit=cp.matmul(circuit,get_error_matrix(self.bitnumber,errorp,error_size=error_size))
-			circuit = cp.matmul(circuit,self.quantum_oracle)
-			if errorp is not None:
-				if random.random() <= errorp: circuit=cp.matmul(circuit,get_error_matrix(self.bitnumber,errorp,error_size=error_size))
-			circuit = cp.matmul(circuit,self.diffuser)
-			if errorp is not None:
-				if random.random() <= errorp: circuit=cp.matmul(circuit,get_error_matrix(self.bitnumber,errorp,error_size=error_size))
+		events = [False]*iterations*3
+		if noise is not None:
+			if fired is None:
+				gates = noise.next_schedule(self.bitnumber,3*iterations)
+			else:
+				gates = noise.sample_schedule(self.bitnumber,3*iterations,fired=fired)
+			events = list(np.isin(np.arange(3*iterations),gates["location"]))
+			error = lambda state,location: noise_model.apply_gates(state,gates[gates["location"] == location],self.bitnumber,xp=cp)
+		elif errorp is not None:
+			error_model = error_model if error_model != None else "rotation"
+			rng = get_rng(rng)
+			if error_model == "rotation":
+				error = lambda state,location: cp.matmul(get_error_matrix(self.bitnumber,errorp,error_size=error_size,rng=rng),state)
+			else:
+				error = lambda state,location: apply_pauli_error(state,self.bitnumber,errorp,channel=error_model,rng=rng)
+			events = list(rng.random(3*iterations) <= errorp)	# Error locations around the diffuser and oracle
+		if not any(events):
+			target_cpu = cp.asnumpy(self.evolve(iterations))
+			if self.verbose: print("\nDone!")
+			return target_cpu
+
+		first_iteration = events.index(True)//3
+		state = self.evolve(first_iteration)
+		for i in range(first_iteration,iterations):
+			if events[3*i]: state = error(state,3*i)
+			state = cp.matmul(self.diffuser,state)
+			if events[3*i+1]: state = error(state,3*i+1)
+			state = cp.matmul(self.quantum_oracle,state)
+			if events[3*i+2]: state = error(state,3*i+2)
 			
 			if self.verbose: print("Started {}/{} Grover Iterations".format(i+1,iterations),end="\r",flush=True)
 
-		target = cp.matmul(circuit,target_state)
 		if self.verbose: print("\nFinalising calculations. This may take a little while, please wait...")
-		target_cpu = cp.asnumpy(target)
+		target_cpu = cp.asnumpy(state)
 		if self.verbose: print("Done!")
 		return target_cpu
 
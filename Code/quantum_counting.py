@@ -0,0 +1,46 @@
+import numpy as np
+import quantum_backend as quantum
+import shor
+
+def get_counting_distribution(grover,precision):
+	"""
+	Runs quantum counting (phase estimation of the Grover operator) and returns the exact
+	probability distribution of the precision register, before measurement.
+	The precision register holds sum_j |j>G^j|s>, built one Grover iteration at a time,
+	and is then sent through the same IQFT used by Shor's algorithm.
+	grover = Grover instance holding the oracle whose marked states are counted (Grover)
+	precision = number of qubits in the precision register (int)
+	"""
+	T = 2**precision
+	joint_state = np.empty((T,2**grover.bitnumber),dtype=complex)	# Row j is the search register paired with |j>
+	joint_state[0] = grover.initial_state()
+	for j,state in enumerate(grover.iterate(T-1)):
+		joint_state[j+1] = state
+	joint_state /= np.sqrt(T)
+	joint_state = np.matmul(shor.get_IQFT_matrix(precision),joint_state)
+	return np.sum(np.abs(joint_state)**2,axis=1)
+
+def estimate_marked(grover,precision=None,rng=None):
+	"""
+	Estimates the number of marked states M from a single measurement of the counting circuit.
+	grover = Grover instance holding the oracle whose marked states are counted (Grover)
+	precision = number of qubits in the precision register. If not specified, bits/2+2 are used (int)
+	rng = random number generator, see quantum_backend.get_rng (numpy Generator)
+	"""
+	precision = precision if precision != None else int(np.ceil(grover.bitnumber/2))+2
+	probabilities = get_counting_distribution(grover,precision)
+	y = quantum.measure(np.sqrt(probabilities),rng=rng)	# measure() squares the components it is given
+	return 2**grover.bitnumber*np.sin(np.pi*y/2**precision)**2
+
+def counted_search(grover,precision=None,errorp=None,rng=None):
+	"""
+	Estimates the number of marked states with quantum counting, then runs a single Grover search
+	with the iteration count that is optimal for that estimate. Returns (measured state, estimate).
+	If no marked states are detected, no search is performed and None is returned as the state.
+	"""
+	rng = quantum.get_rng(rng)
+	marked = estimate_marked(grover,precision=precision,rng=rng)
+	if np.round(marked) == 0:
+		return (None,marked)
+	iterations = quantum.optimal_iterations(grover.bitnumber,marked)
+	return (quantum.measure(grover.search(iterations,errorp=errorp,rng=rng),rng=rng),marked)
@@ -0,0 +1,82 @@
+import numpy as np
+import hashlib, json, os, shutil
+import results_store
+
+code_version = None	# Looked up once per process, as git is slow compared to a cache hit
+
+def get_key(config):
+	"""
+	Content address of a simulation configuration: the sha256 hash of its canonical json form, together with
+	the version of the code. The same algorithm, parameters, noise model, backend and seed always give the same key.
+	config = everything the result depends on (dict)
+	"""
+	global code_version
+	if code_version is None:
+		code_version = results_store.get_code_version() or "unknown"
+	config = dict(config,code_version=code_version)
+	text = json.dumps(config,sort_keys=True,default=lambda value: value.item() if isinstance(value,np.generic) else str(value))
+	return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ResultCache:
+
+	def __init__(self,folder=None,max_bytes=None):
+		"""
+		On-disk cache of simulation results keyed by a hash of their configuration, so a repeated configuration
+		is read back instead of simulated again. Each entry is saved with results_store. When the cache grows
+		beyond max_bytes the least recently used entries are removed.
+		folder = folder holding the cache (str)
+		max_bytes = maximum total size of the cached arrays. Defaults to 1 GiB (int)
+		"""
+		self.folder = folder if folder != None else "result_cache"
+		self.max_bytes = max_bytes if max_bytes != None else 2**30
+		os.makedirs(self.folder,exist_ok=True)
+
+	def get(self,config):
+		"""
+		Returns the cached arrays of a configuration as a dictionary, or None if it has not been cached.
+		"""
+		entry = os.path.join(self.folder,get_key(config))
+		metadata = os.path.join(entry,"metadata.json")
+		if not os.path.exists(metadata):
+			return None
+		os.utime(metadata)	# Mark as recently used
+		results = results_store.load_results(entry,mmap=False)
+		return {name:results[name] for name in results.names()}
+
+	def put(self,config,arrays):
+		"""
+		Caches the arrays computed for a configuration, then evicts old entries if the cache is too large.
+		"""
+		entry = os.path.join(self.folder,get_key(config))
+		results_store.save_results(entry,arrays,metadata={"config":config})
+		self.evict()
+
+	def cached(self,config,compute):
+		"""
+		Returns the cached arrays of a configuration, calling compute() and caching its arrays on a miss.
+		compute = function returning the arrays of the configuration (function)
+		"""
+		arrays = self.get(config)
+		if arrays is None:
+			arrays = compute()
+			self.put(config,arrays)
+		return arrays
+
+	def evict(self):
+		"""
+		Removes the least recently used entries until the cache fits in max_bytes.
+		"""
+		entries = []
+		for key in os.listdir(self.folder):
+			entry = os.path.join(self.folder,key)
+			metadata = os.path.join(entry,"metadata.json")
+			if not os.path.exists(metadata):
+				continue
+			size = sum(os.path.getsize(os.path.join(entry,name)) for name in os.listdir(entry))
+			entries.append((os.path.getmtime(metadata),size,entry))
+		total = sum(size for last_used,size,entry in entries)
+		for last_used,size,entry in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			shutil.rmtree(entry,ignore_errors=True)
+			total -= size
@@ -0,0 +1,91 @@
+import numpy as np
+import hashlib, json, os, pickle, subprocess, time
+
+def get_code_version():
+	"""
+	Commit of the code that produced a result. If there are uncommitted changes, "-dirty-" and a hash of
+	them (the diff against the commit and every untracked .py file) is appended, so that each edited
+	version of the code has its own version. Returns None outside a git checkout.
+	"""
+	folder = os.path.dirname(os.path.abspath(__file__))
+	try:
+		git = lambda *arguments: subprocess.run(["git",*arguments],cwd=folder,capture_output=True,check=True).stdout
+		commit = git("rev-parse","HEAD").decode().strip()
+		diff = git("diff","HEAD","--binary")
+		untracked = git("ls-files","--others","--exclude-standard","-z","--full-name","--","*.py").split(b"\0")
+		root = git("rev-parse","--show-toplevel").decode().strip()
+	except (OSError,subprocess.CalledProcessError):
+		return None
+	untracked = [name for name in untracked if name]
+	if not diff and not untracked:
+		return commit
+	changes = hashlib.sha256(diff)
+	for name in sorted(untracked):
+		changes.update(name+b"\0")
+		with open(os.path.join(root,name.decode()),"rb") as file:
+			changes.update(file.read())
+	return "{}-dirty-{}".format(commit,changes.hexdigest()[:12])
+
+def save_results(folder,arrays,metadata=None):
+	"""
+	Saves the arrays of a sweep to a folder, one .npy file per array, next to a metadata.json file holding
+	the parameters of the sweep, the code version and the name, shape and dtype of every array.
+	folder = folder to save to, created if it does not exist (str)
+	arrays = named arrays to save (dict of numpy arrays or lists)
+	metadata = parameters, seeds, backend and anything else needed to interpret the results (dict)
+	"""
+	metadata = dict(metadata) if metadata != None else {}
+	os.makedirs(folder,exist_ok=True)
+	metadata["arrays"] = {}
+	for name,array in arrays.items():
+		array = np.asarray(array)
+		np.save(os.path.join(folder,name+".npy"),array)
+		metadata["arrays"][name] = {"shape":list(array.shape),"dtype":array.dtype.str}
+	metadata.setdefault("code_version",get_code_version())
+	metadata.setdefault("created",time.strftime("%Y-%m-%dT%H:%M:%S"))
+	with open(os.path.join(folder,"metadata.json"),"w") as file:
+		json.dump(metadata,file,indent=4,default=lambda value: value.item() if isinstance(value,np.generic) else str(value))
+
+class Results:
+
+	def __init__(self,folder,mmap=None):
+		"""
+		Saved results of a sweep. Arrays are only read from disk when first accessed, and are memory-mapped
+		by default so that slicing a large frequency table reads just the slice.
+		Folders of pickled lists written by the old RSA_breaker.write can be read too.
+		folder = folder written by save_results (str)
+		mmap = memory-map the arrays instead of reading them into memory (bool)
+		"""
+		self.folder = folder
+		self.mmap = mmap if mmap != None else True
+		self.arrays = {}
+		path = os.path.join(folder,"metadata.json")
+		if os.path.exists(path):
+			with open(path) as file:
+				self.metadata = json.load(file)
+		else:	# Legacy folder of pickles
+			self.metadata = {"arrays":{name:{} for name in sorted(os.listdir(folder)) if os.path.isfile(os.path.join(folder,name))}}
+
+	def __getitem__(self,name):
+		if name not in self.arrays:
+			path = os.path.join(self.folder,name+".npy")
+			if os.path.exists(path):
+				self.arrays[name] = np.load(path,mmap_mode="r" if self.mmap else None)
+			elif os.path.exists(os.path.join(self.folder,name)):
+				with open(os.path.join(self.folder,name),"rb") as file:
+					self.arrays[name] = np.asarray(pickle.load(file))
+			else:
+				raise KeyError("No array {} in {}".format(name,self.folder))
+		return self.arrays[name]
+
+	def __contains__(self,name):
+		return name in self.metadata["arrays"]
+
+	def names(self):
+		return list(self.metadata["arrays"])
+
+def load_results(folder,mmap=None):
+	"""
+	Opens the results saved in a folder. See Results.
+	"""
+	return Results(folder,mmap=mmap)
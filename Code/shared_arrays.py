@@ -0,0 +1,67 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+attached = {}	# Arrays attached in this process, by name
+blocks = []		# Shared memory blocks attached in this process, kept open while their arrays are in use
+
+class SharedArrays:
+
+	def __init__(self,arrays):
+		"""
+		Publishes arrays into shared memory once, so that worker processes can attach them without copying.
+		Pass handles to attach in each worker, and call close in the publishing process when the workers are done.
+		arrays = named arrays to publish (dict of numpy arrays)
+		"""
+		self.blocks = []
+		self.handles = {}	# Name, shape and dtype of each block, small enough to send to every worker
+		for name,array in arrays.items():
+			array = np.ascontiguousarray(array)
+			block = shared_memory.SharedMemory(create=True,size=max(array.nbytes,1))
+			np.ndarray(array.shape,dtype=array.dtype,buffer=block.buf)[...] = array
+			self.blocks.append(block)
+			self.handles[name] = (block.name,array.shape,array.dtype.str)
+
+	def close(self):
+		"""
+		Frees the shared memory. Arrays attached from it must no longer be used.
+		"""
+		for block in self.blocks:
+			block.close()
+			block.unlink()
+		self.blocks = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*exception):
+		self.close()
+
+def attach(handles):
+	"""
+	Attaches published arrays in this process as read-only views of the shared memory, making them available
+	through get and get_group. Suitable as the initializer of a process pool.
+	handles = SharedArrays.handles of the publishing process (dict)
+	"""
+	for name,(block_name,shape,dtype) in handles.items():
+		try:
+			block = shared_memory.SharedMemory(name=block_name,track=False)	# Python 3.13+, the publisher owns the block
+		except TypeError:	# Pool workers share the publisher's resource tracker, so registering again is harmless
+			block = shared_memory.SharedMemory(name=block_name)
+		array = np.ndarray(shape,dtype=np.dtype(dtype),buffer=block.buf)
+		array.flags.writeable = False
+		blocks.append(block)
+		attached[name] = array
+
+def get(name):
+	"""
+	Returns an attached array, or None if no array of that name was published to this process.
+	"""
+	return attached.get(name)
+
+def get_group(prefix):
+	"""
+	Returns the attached arrays whose names start with prefix + "/", keyed by the rest of their name,
+	or None if there are none. Lets one sweep publish the operators of several objects.
+	"""
+	group = {name[len(prefix)+1:]:array for name,array in attached.items() if name.startswith(prefix+"/")}
+	return group if group else None
@@ -1,5 +1,7 @@
 import numpy as np
-import random, fractions, itertools, time
+import fractions, itertools, time
+import noise_model
+import quantum_backend
 
 def extend_unary(targets=None,gate=None,bits=None,verbose=None):
     """
@@ -89,13 +91,14 @@ def extend_binary(q=None,gate=None,bits=None):
     final_gate = np.matmul(swapper2,final_gate)
     return final_gate
 
-def measure(inputq):
+def measure(inputq,rng=None):
     """
     Measures the N qubit register, simulating quantum randomness.
     Uses algorithm given in quantum_computer.pdf
+    rng = random number generator, see quantum_backend.get_rng (numpy Generator)
     """
     q=0
-    r = random.uniform(0,1)#Random number between 0 and 1
+    r = quantum_backend.get_rng(rng).random()#Random number between 0 and 1
     qbitnum = int(np.log2(len(inputq)))#Number of qubits
     check = list(itertools.product("01",repeat = qbitnum))#Creates a list of every possible combination of 0 and 1
     for i,state_component in enumerate(inputq):
@@ -105,8 +108,9 @@ def measure(inputq):
             break
     return out
 
-def get_error_matrix(bits,errorp,error_size=None):
+def get_error_matrix(bits,errorp,error_size=None,rng=None):
     error_size = error_size if error_size != None else 0.1
+    rng = quantum_backend.get_rng(rng)
     # Define generators of U(2) and the identity matrix
     X = np.array([[0,1],[1,0]])
     Y = np.array([[0,-1j],[1j,0]])
@@ -114,20 +118,20 @@ def get_error_matrix(bits,errorp,error_size=None):
     I = np.array([[1,0],[0,1]])
 
     # Create a list of targets to apply random error "gates" to
-    targets = [[random.randint(0,bits-1)]]
+    targets = [[int(rng.integers(0,bits))]]
     for i in range(bits):
         if i in targets:
             continue
-        elif random.random() <= errorp:
+        elif rng.random() <= errorp:
             targets.append([i])
     
     matrices = []
     for target in targets:
-        n_vec = np.random.rand(3)   # Create randomised axis vector for the gate
+        n_vec = rng.random(3)   # Create randomised axis vector for the gate
         for i,component in enumerate(n_vec):
-            n_vec[i] = component*((-1)**random.randint(0,1))    # Flip sign of components at random
+            n_vec[i] = component*((-1)**rng.integers(0,2))    # Flip sign of components at random
         n_vec = n_vec/np.linalg.norm(n_vec)     # Ensure the axis vector is normalised
-        angle = (4*np.pi*error_size)*random.random()    # Pick a random angle between 0 and pi/8
+        angle = (4*np.pi*error_size)*rng.random()    # Pick a random angle between 0 and pi/8
         matrix = np.cos(angle/2)*I-1j*np.sin(angle/2)*(n_vec[0]*X+n_vec[1]*Y+n_vec[2]*Z)    # Construct the gate
         extended_matrix = extend_unary(targets=target,gate=matrix,bits=bits)    # Extend the gate to the multi-qubit setup
         matrices.append(extended_matrix)
@@ -138,17 +142,72 @@ def get_error_matrix(bits,errorp,error_size=None):
         error_matrix = np.matmul(error_matrix,matrix)
     return error_matrix
 
+def get_IQFT_matrix(bits,ancillary_bits=None):
+    """
+    Inverse quantum fourier transform matrix from its mathematical definition
+    bits = number of qubits in the register the IQFT acts on (int)
+    ancillary_bits = number of trailing qubits left untouched by the IQFT (int)
+    """
+    ancillary_bits = ancillary_bits if ancillary_bits != None else 0
+    N = 2**bits
+    exponents = np.outer(np.arange(N),np.arange(N))%N  # Reduce i*j mod N so large registers keep their precision
+    IQFT_matrix = np.exp(-2*np.pi*1j*exponents/N)
+    IQFT_matrix *= 1/(np.sqrt(N))
+    for i in range(ancillary_bits):
+        IQFT_matrix = np.kron(IQFT_matrix,np.identity(2))
+    return IQFT_matrix
+
+def apply_pauli_error(state,bits,errorp,channel=None,rng=None):
+    """
+    Applies a random Pauli error to a state vector using only index and sign operations.
+    X is an XOR permutation of the basis indices, Z is a sign flip and Y is both.
+    Y is applied as XZ, which differs from Y only by a global phase, so real states stay real.
+    Targets are chosen as in get_error_matrix: one random qubit, plus each other qubit with probability errorp.
+    state = state vector the error acts on (numpy array)
+    bits = number of qubits (int)
+    errorp = probability of an error on each additional qubit (float)
+    channel = "bit_flip" (X), "phase_flip" (Z) or "depolarising" (random X, Y or Z). Defaults to "depolarising" (str)
+    rng = random number generator, see quantum_backend.get_rng (numpy Generator)
+    """
+    channel = channel if channel != None else "depolarising"
+    if channel not in ("bit_flip","phase_flip","depolarising"):
+        raise ValueError("Unknown Pauli channel: {}".format(channel))
+    rng = quantum_backend.get_rng(rng)
+    targets = [int(rng.integers(0,bits))]
+    for i in range(bits):
+        if i in targets:
+            continue
+        elif rng.random() <= errorp:
+            targets.append(i)
+
+    indices = np.arange(2**bits)
+    for target in targets:
+        if channel == "bit_flip":
+            pauli = "X"
+        elif channel == "phase_flip":
+            pauli = "Z"
+        else:
+            pauli = "XYZ"[rng.integers(0,3)]
+        mask = 1 << (bits-1-target)    # Qubit 0 is the most significant bit, as in extend_unary
+        if pauli in "YZ":
+            state = state*np.where(indices & mask,-1,1)
+        if pauli in "XY":
+            state = state[indices ^ mask]
+    return state
+
 class shor:
 
-    def __init__(self,N,a=None,bits=None,verbose=None):
+    def __init__(self,N,a=None,bits=None,verbose=None,rng=None,operators=None):
         """
         Class to handle shor's algorithm
         N = target number to factorise
         a = pivot for shor's algorithm. If not specified, a random number less than N is chosen
         bits = number of qubits in the main register. If not specified, there are 2n qubits for an n-bit value of N
+        rng = random number generator a is drawn from, see quantum_backend.get_rng (numpy Generator)
+        operators = precomputed matrices of this N, a and bits, as returned by get_operators, used instead of computing them (dict)
         """
         self.N = N
-        self.a = a if a!= None else random.randint(1,N-1)
+        self.a = a if a!= None else int(quantum_backend.get_rng(rng).integers(1,N))
         self.verbose = verbose if verbose != None else False   
 
         # For an n-bit integer, there should be n ancillary qubits
@@ -159,7 +218,17 @@ class shor:
         if verbose: print("Ancillary Bits: {}, Total Bits: {}".format(self.ancillary_bitnumber,self.bits))
         # Construct IQFT matrix
         self.HADAMARD = 1/(np.sqrt(2))*np.array([[1,1],[1,-1]],dtype=np.float32)
-        self.IQFT = self.get_IQFT_matrix_v2()
+        operators = operators if operators != None else {}
+        self.IQFT = operators["IQFT"] if "IQFT" in operators else self.get_IQFT_matrix_v2()
+        self.noiseless_circuit = operators.get("noiseless_circuit")   # Hadamards and controlled U gates, built on the first run
+        self.noiseless_state = operators.get("noiseless_state")
+
+    def get_operators(self):
+        """
+        Returns the precomputed matrices of the circuit, so they can be shared with other instances
+        for the same N, a and bits, for example through shared_arrays.
+        """
+        return {"IQFT":self.IQFT,"noiseless_circuit":self.get_noiseless_circuit(),"noiseless_state":self.get_noiseless_state()}
 
     def get_IQFT_matrix(self):
         """
@@ -189,15 +258,7 @@ class shor:
         By default this method remains unused!
         """
         if self.verbose: print("Computing IQFT matrix for {} bits in working register".format(self.main_bitnumber))
-        N = 2**self.main_bitnumber
-        omega = np.exp(-2*np.pi*1j/N)
-        IQFT_matrix = np.array([[0 for j in range(N)] for i in range(N)],dtype=complex)
-        for i in range(N):
-            for j in range(N):
-                IQFT_matrix[i][j] = omega**(i*j)
-        IQFT_matrix *= 1/(np.sqrt(N))
-        for i in range(self.ancillary_bitnumber):
-            IQFT_matrix = np.kron(IQFT_matrix,np.identity(2))
+        IQFT_matrix = get_IQFT_matrix(self.main_bitnumber,ancillary_bits=self.ancillary_bitnumber)
         if self.verbose: print("Done!")
         return IQFT_matrix
 
@@ -232,27 +293,86 @@ class shor:
             CU[j][column_number] = 1
         return CU
 
-    def run_algorithm(self,errorp=None,error_size=None):
+    def get_noiseless_circuit(self):
+        """
+        Returns the Hadamard and controlled U part of the circuit as one matrix, computing it on first use.
+        """
+        if self.noiseless_circuit is None:
+            circuit = extend_unary(targets=[i for i in range(self.main_bitnumber)],gate=self.HADAMARD,bits=self.bits)
+            for i in reversed(range(self.main_bitnumber)):#Do the U gates
+                UGATE = self.construct_CU_matrix(i)
+                if self.verbose: print("Computed {}/{} controlled U gates".format(self.main_bitnumber-i,self.main_bitnumber),end="\r",flush=True)
+                circuit = np.matmul(UGATE,circuit)
+            if self.verbose: print()
+            self.noiseless_circuit = circuit
+        return self.noiseless_circuit
+
+    def get_initial_state(self):
+        """
+        Returns the initial state of the register, with the ancillary register set to 1.
+        """
+        q_vec = np.array([0 for i in range(2**self.bits)])
+        q_vec[1] = 1
+        return q_vec
+
+    def get_noiseless_state(self):
+        """
+        Returns the state before the ancillary measurement when no error fires, computing it on first use.
+        """
+        if self.noiseless_state is None:
+            self.noiseless_state = np.matmul(self.get_noiseless_circuit(),self.get_initial_state())
+        return self.noiseless_state
+
+    def get_phase_distribution(self):
+        """
+        Exact probability of every output x/2^L of the noiseless algorithm, indexed by x, without sampling.
+        The IQFT acts on the working register amplitudes for every value of the ancillary register, and the
+        ancillary outcomes are then summed over, as in the textbook circuit where only the ancillary register is
+        measured before the IQFT. run_algorithm differs: its measure collapses the whole register, working qubits
+        included, so the IQFT acts on a basis state and its sampled outputs are spread evenly over every x.
+        """
+        final_probabilities = np.abs(np.matmul(self.IQFT,self.get_noiseless_state()))**2
+        # Qubit 0 is the most significant bit, as in the IQFT matrix, so the peaks fall at multiples of 2^L/period
+        return quantum_backend.marginal(final_probabilities,list(range(self.main_bitnumber)),probabilities=True)
+
+    def run_algorithm(self,errorp=None,error_size=None,error_model=None,noise=None,rng=None):
         """
         Calculates the output x/2^L ("phase") of Shor's algorithm for a given value of a
+        The error events are sampled first, so that the cached noiseless state can be reused when none
+        fire before the ancillary measurement, and the cached noiseless circuit otherwise.
+        error_model = "rotation" for random SU(2) rotations, or a Pauli channel accepted by apply_pauli_error (str)
+        noise = noise model providing a pre-sampled error schedule, used instead of errorp, error_size and error_model (NoiseModel)
+        rng = random number generator the errors and measurements are drawn from, see quantum_backend.get_rng (numpy Generator)
         """
+        rng = quantum_backend.get_rng(rng)
+        error_model = error_model if error_model != None else "rotation"
+        if error_model == "rotation":
+            error = lambda state,location: np.matmul(get_error_matrix(self.bits,errorp,error_size=error_size,rng=rng),state)
+        else:
+            error = lambda state,location: apply_pauli_error(state,self.bits,errorp,channel=error_model,rng=rng)
+
         k = np.gcd(self.a,self.N)
         if k != 1:  # If a is already a non-trivial factor of N we are done
             if self.verbose: print("Random value a was already a non-trivial factor!")
             return ([self.N//k,k],True)   # Return True in second argument to flag algorithm was skipped
 
-        circuit = extend_unary(targets=[i for i in range(self.main_bitnumber)],gate=self.HADAMARD,bits=self.bits)
-        for i in reversed(range(self.main_bitnumber)):#Do the U gates
-            UGATE = self.construct_CU_matrix(i)
-            if self.verbose: print("Computed {}/{} controlled U gates".format(self.main_bitnumber-i,self.main_bitnumber),end="\r",flush=True)
-            if errorp is not None:
-                if random.random() <= errorp: circuit=np.matmul(circuit,get_error_matrix(self.bits,errorp,error_size=error_size))
-            circuit = np.matmul(UGATE,circuit)
-        if self.verbose: print("\nMeasuring ancillary qubits...")
-        q_vec = np.array([0 for i in range(2**self.bits)])
-        q_vec[1] = 1
-        q_vec = np.matmul(circuit,q_vec)
-        collapsed = measure(q_vec)  # Measure ancillary register as part of Shor's algorithm
+        events = [False for i in range(self.main_bitnumber+2)]
+        if noise is not None:
+            gates = noise.next_schedule(self.bits,self.main_bitnumber+2)
+            events = list(np.isin(np.arange(self.main_bitnumber+2),gates["location"]))
+            error = lambda state,location: noise_model.apply_gates(state,gates[gates["location"] == location],self.bits)
+        elif errorp is not None:  # One error location per controlled U gate, and one either side of the IQFT
+            events = list(rng.random(self.main_bitnumber+2) <= errorp)
+        if not any(events[:self.main_bitnumber]):
+            q_vec = self.get_noiseless_state()
+        else:
+            # Errors on the U gates act on the initial state, as the circuit was built by right-multiplication
+            q_vec = self.get_initial_state()
+            for location,event in enumerate(events[:self.main_bitnumber]):
+                if event: q_vec = error(q_vec,location)
+            q_vec = np.matmul(self.get_noiseless_circuit(),q_vec)
+        if self.verbose: print("Measuring ancillary qubits...")
+        collapsed = measure(q_vec,rng=rng)  # Measure ancillary register as part of Shor's algorithm
         states = []
         for i in collapsed: # Convert measurement into a state vector
             if i == "0":
@@ -267,14 +387,11 @@ class shor:
                 collapsed_statevec = np.kron(collapsed_statevec,entry)
         collapsed_statevec = collapsed_statevec/np.linalg.norm(collapsed_statevec)
         if self.verbose: print("Applying IQFT to working register")
-        new_circuit = np.identity(2**self.bits)
-        if errorp is not None:
-                if random.random() <= errorp: new_circuit=np.matmul(get_error_matrix(self.bits,errorp,error_size=error_size),new_circuit)
-        new_circuit = np.matmul(self.IQFT,new_circuit)
-        if errorp is not None:
-                if random.random() <= errorp: new_circuit=np.matmul(get_error_matrix(self.bits,errorp,error_size=error_size),new_circuit)
-        final_state = np.matmul(new_circuit,collapsed_statevec)   # Send main register through IQFT
-        result = measure(final_state)
+        final_state = collapsed_statevec
+        if events[-2]: final_state = error(final_state,self.main_bitnumber)
+        final_state = np.matmul(self.IQFT,final_state)   # Send main register through IQFT
+        if events[-1]: final_state = error(final_state,self.main_bitnumber+1)
+        result = measure(final_state,rng=rng)
         x_register_result = result[:self.main_bitnumber]
         if self.verbose: print("Measured state:",x_register_result)
         int_result = int("".join(x_register_result[::-1]),2)
@@ -286,40 +403,54 @@ class shor:
         """
         Calculate the resulting period for a given output of Shor's algorithm.
         """
-        phase_frac = contfraction(phase)
-        max_trials = 10
-        if self.verbose: print("Finding period using output of Shor's algorithm")
-        searching = True
-        while searching:
-            expansion = phase_frac.expand(max_trials)
-            trial_period = phase_frac.frac.denominator
-            if expansion != []:
-                for i in range(1,len(expansion)+1):
-                    seq = expansion[:i]
-                    d,s = phase_frac.contfrac_to_frac(seq)
-                    r = abs(phase-d/s)<1/(2*phase_frac.frac.denominator)
-                    if s<self.N and r:
-                        trial_period = s
-                        break
-            i=1
-            while True:
-                period = trial_period*i
-                if self.a**period%self.N == 1:
-                    searching = False
-                    break
-                else:
-                    i+=1
-                if i > max_trials:
-                    max_trials += 10
-                    if self.verbose: print("Chosen search size was too small, restarting search with larger radius")
-                    break
-        if self.verbose: print("Done!")
-        return period
+        return get_period(phase,self.a,self.N,verbose=self.verbose)
 
     def get_factors(self,p):
-        p=int(np.ceil(p))
-        guesses = [np.gcd(self.a**(p//2)-1, self.N), np.gcd(self.a**(p//2)+1, self.N)]
-        return guesses
+        return get_factors(p,self.a,self.N)
+
+def get_period(phase,a,N,verbose=None):
+    """
+    Calculate the period of a^x mod N from an output x/2^L ("phase") of Shor's algorithm.
+    Needs no quantum state, so it can run apart from the simulation, for example in pipeline.run_pipeline.
+    """
+    verbose = verbose if verbose != None else False
+    phase_frac = contfraction(phase)
+    max_trials = 10
+    if verbose: print("Finding period using output of Shor's algorithm")
+    searching = True
+    while searching:
+        expansion = phase_frac.expand(max_trials)
+        trial_period = phase_frac.frac.denominator
+        if expansion != []:
+            for i in range(1,len(expansion)+1):
+                seq = expansion[:i]
+                d,s = phase_frac.contfrac_to_frac(seq)
+                r = abs(phase-d/s)<1/(2*phase_frac.frac.denominator)
+                if s<N and r:
+                    trial_period = s
+                    break
+        i=1
+        while True:
+            period = trial_period*i
+            if pow(a,period,N) == 1:
+                searching = False
+                break
+            else:
+                i+=1
+            if i > max_trials:
+                max_trials += 10
+                if verbose: print("Chosen search size was too small, restarting search with larger radius")
+                break
+    if verbose: print("Done!")
+    return period
+
+def get_factors(p,a,N):
+    """
+    Candidate factors of N from the period p of a^x mod N.
+    """
+    p=int(np.ceil(p))
+    guesses = [np.gcd(a**(p//2)-1, N), np.gcd(a**(p//2)+1, N)]
+    return guesses
 
 class contfraction:
 
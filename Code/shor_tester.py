@@ -1,8 +1,78 @@
-import shor
+import shor, sweep, result_cache, shared_arrays, pipeline
 import numpy as np
+import functools
 import matplotlib.pyplot as plt
 
-def test_factorising_success():
+@functools.lru_cache(maxsize=None)
+def get_shor(target,a,bits):
+	# One instance per worker, so its cached circuits are reused. Matrices published by the sweep are attached, not rebuilt
+	operators = shared_arrays.get_group("shor_{}_{}_{}".format(target,a,bits))
+	return shor.shor(target,a=a,bits=bits,verbose=False,operators=operators)
+
+def get_shared_operators(target,a,bit_sizes):
+	"""
+	Matrices of every register size in a sweep, built once here to be published to the sweep's workers.
+	"""
+	shared = {}
+	for bits in bit_sizes:
+		for name,array in get_shor(target,a,bits).get_operators().items():
+			shared["shor_{}_{}_{}/{}".format(target,a,bits,name)] = array
+	return shared
+
+def factorise_shot(target,a,bits,factors,errorp=None,error_size=None,rng=None):
+	"""
+	Runs one shot of Shor's algorithm and returns whether target was factorised into the expected factors.
+	factors = the expected non-trivial factors of target (tuple)
+	"""
+	J = get_shor(target,a,bits)
+	try:
+		phase = J.run_algorithm(errorp=errorp,error_size=error_size,rng=rng)[0]
+		p = J.get_period(phase)
+		result = J.get_factors(p)
+		return sorted(result) == sorted(factors)
+	except:
+		return False
+
+def simulate_factorise(target,a,bits,errorp=None,error_size=None,rng=None):
+	"""
+	Quantum half of factorise_shot, returning the output of run_algorithm or None if the simulation failed.
+	"""
+	try:
+		return (a,target,get_shor(target,a,bits).run_algorithm(errorp=errorp,error_size=error_size,rng=rng))
+	except:
+		return (a,target,None)
+
+def check_factors(simulated,factors=None):
+	"""
+	Classical half of factorise_shot: finds the period and factors from the output of simulate_factorise
+	and returns whether they are the expected factors.
+	"""
+	factors = factors if factors != None else (3,5)
+	a,target,output = simulated
+	try:
+		p = shor.get_period(output[0],a,target)
+		return sorted(shor.get_factors(p,a,target)) == sorted(factors)
+	except:
+		return False
+
+def test_factorising_pipelined(seed=None):
+	"""
+	Success probability of factorising 15 with each working register size, post-processing finished
+	shots in a separate process while later shots are still being simulated.
+	"""
+	target = 15
+	a = 7
+	shots = 1000
+	bit_sizes = [3,4,5,6]
+	jobs = [(target,a,bits) for bits in bit_sizes for i in range(shots)]
+	results = np.array(list(pipeline.run_pipeline(simulate_factorise,check_factors,jobs,seed=seed,verbose=True)),dtype=float).reshape(len(bit_sizes),shots)
+	for bits,result in zip(bit_sizes,results):
+		print("{} working bits: success probability {:.3f} +/- {:.3f}".format(bits,np.mean(result),np.std(result)/np.sqrt(shots)))
+
+def test_factorising_success(seed=None):
+	"""
+	seed = seed of the sweep. Results are only cached when it is given (int)
+	"""
 	target = 15
 	min_bitnumber = 3
 	max_bitnumber = 6
@@ -10,33 +80,10 @@ def test_factorising_success():
 	shots = 100
 	trials = 100
 	bit_sizes = [i for i in range(min_bitnumber,max_bitnumber+1)]
-	results = [[] for i in range(min_bitnumber,max_bitnumber+1)]
-	for bitnumber in bit_sizes:
-		print("Testing {} working bits".format(bitnumber))
-		J=shor.shor(target,a=a,bits=bitnumber,verbose=False)
-		for j in range(trials):
-			temp = []
-			for i in range(shots):
-				try:
-					phase = J.run_algorithm(errorp=0)[0]
-					p = J.get_period(phase)
-					result = J.get_factors(p)
-					if result == [3,5] or result == [5,3]:
-						temp.append(1)
-					else:
-						temp.append(0)
-				except:
-					temp.append(0)
-				print("Completed {}/{} shots, {}/{} trials".format(i+1,shots,j,trials),end="\r",flush=True)
-			success = np.mean(temp)
-			results[bitnumber-min_bitnumber].append(success)
-		print("\n")
-	y = []
-	errors = []
-	for result_list in results:
-		y.append(np.mean(result_list))
-		errors.append(np.std(result_list)/np.sqrt(trials))
-	print(results)
+	shot = functools.partial(factorise_shot,target=target,a=a,factors=(3,5),errorp=0)
+	shared = get_shared_operators(target,a,bit_sizes)
+	y,errors = sweep.run_sweep(shot,{"bits":bit_sizes},shots,trials,seed=seed,cache=result_cache.ResultCache(),shared=shared)
+	print(y)
 	fig,ax=plt.subplots()
 	ax.errorbar(bit_sizes, y, yerr=errors, fmt="o", ecolor="gray", elinewidth=0.75, capsize=3)
 	plt.xticks(bit_sizes)
@@ -49,49 +96,25 @@ measured over {} trials of {} shots""".format(trials,shots)
 	plt.show()
 
 
-def test_errorp():
-	y = [[] for i in range(3)]
-	errors = [[] for i in range(3)]
+def test_errorp(log=None,seed=None):
+	"""
+	log = file every completed trial is appended to. Rerunning with the same log resumes an interrupted sweep (str)
+	seed = seed of the sweep. Results are only cached when it is given (int)
+	"""
 	error_size_list = [0.1,0.2,0.3]
-	for num,error_size in enumerate(error_size_list):
-		print("------------------------------------------")
-		print("Error Size = {}".format(error_size))
-		target = 15
-		bitnumber = 4
-		a = 7
-		shots = 100
-		trials = 20
-		errorp_step = 0.2
-		errorp_list = np.array([i*errorp_step for i in range(int(1/errorp_step)+1)])
-		results = [[] for i in range(int(1/errorp_step)+1)]
-		for errorp in errorp_list:
-			print("Testing errorp={}".format(errorp))
-			J=shor.shor(target,a=a,bits=bitnumber,verbose=False)
-			for j in range(trials):
-				temp = []
-				for i in range(shots):
-					try:
-						phase = J.run_algorithm(errorp=errorp,error_size=error_size)[0]
-						p = J.get_period(phase)
-						result = J.get_factors(p)
-						if result == [3,5] or result == [5,3]:
-							temp.append(1)
-						else:
-							temp.append(0)
-					except:
-						temp.append(0)
-					print("Completed {}/{} shots, {}/{} trials".format(i+1,shots,j,trials),end="\r",flush=True)
-				success = np.mean(temp)
-				results[int(errorp/errorp_step)].append(success)
-			print("Completed {}/{} shots, {}/{} trials".format(i+1,shots,trials,trials),end="\r",flush=True)
-			print("\n")
-		for result_list in results:
-			y[num].append(np.mean(result_list))
-			errors[num].append(np.std(result_list)/np.sqrt(trials))
+	target = 15
+	bitnumber = 4
+	a = 7
+	shots = 100
+	trials = 20
+	errorp_step = 0.2
+	errorp_list = np.array([i*errorp_step for i in range(int(1/errorp_step)+1)])
+	shot = functools.partial(factorise_shot,target=target,a=a,bits=bitnumber,factors=(3,5))
+	shared = get_shared_operators(target,a,[bitnumber])
+	y,errors = sweep.run_sweep(shot,{"error_size":error_size_list,"errorp":list(errorp_list)},shots,trials,seed=seed,log=log,cache=result_cache.ResultCache(),shared=shared)
 
 	b = [-0.01,0,0.01]
 	shapes = ["o","v","*"]
-	#print(results)
 	fig,ax=plt.subplots()
 	for i in range(3):
 		ax.errorbar(errorp_list+b[i], y[i], yerr=errors[i], fmt=shapes[i], ecolor="gray", elinewidth=0.75, capsize=3, label=str(error_size_list[i]))
@@ -108,6 +131,40 @@ Working Register = {} Qubits""".format(target,trials,shots,bitnumber)
 	plt.show()
 
 
+def test_errorp_adaptive(width=None):
+	"""
+	Same sweep as test_errorp, running shots at each point only until its 95% Wilson interval is narrower than width.
+	width = target width of the confidence interval on every success probability (float)
+	"""
+	width = width if width != None else 0.05
+	error_size_list = [0.1,0.2,0.3]
+	target = 15
+	bitnumber = 4
+	a = 7
+	errorp_step = 0.2
+	errorp_list = np.array([i*errorp_step for i in range(int(1/errorp_step)+1)])
+	shot = functools.partial(factorise_shot,target=target,a=a,bits=bitnumber,factors=(3,5))
+	shared = get_shared_operators(target,a,[bitnumber])
+	y,lower,upper,shots = sweep.run_adaptive_sweep(shot,{"error_size":error_size_list,"errorp":list(errorp_list)},width,shared=shared)
+	print("Shots at each point:\n{}\nTotal: {}".format(shots,np.sum(shots)))
+
+	b = [-0.01,0,0.01]
+	shapes = ["o","v","*"]
+	fig,ax=plt.subplots()
+	for i in range(3):
+		ax.errorbar(errorp_list+b[i], y[i], yerr=[y[i]-lower[i],upper[i]-y[i]], fmt=shapes[i], ecolor="gray", elinewidth=0.75, capsize=3, label=str(error_size_list[i]))
+	plt.xticks(errorp_list)
+	plt.xlabel("Probability of error on a qubit")
+	plt.ylabel("Success Probability")
+	plt.legend(title="Error Size")
+	plt.title("""Experimental probability of successfully factorising {}
+for different values of the error probability, with 95% confidence
+intervals narrower than {}. Working Register = {} Qubits""".format(target,width,bitnumber)
+)
+	plt.tight_layout()
+	plt.show()
+
+
 def test_shor_outputs():
 	target = 15
 	main_register_bitnumber = 4
@@ -139,6 +196,25 @@ def test_shor_outputs():
 	plt.title("""L={} bits, tested over {} trials of {} shots, errorp = {}""".format(main_register_bitnumber,trials,shots,errorp))
 	plt.show()
 
+def test_exact_outputs():
+	"""
+	Exact output distribution of the textbook circuit, which only measures the ancillary register before
+	the IQFT. Not the distribution sampled by test_shor_outputs, see shor.get_phase_distribution.
+	"""
+	target = 15
+	main_register_bitnumber = 4
+	a = 7
+	phase_list = [i/(2**main_register_bitnumber) for i in range(2**main_register_bitnumber)]
+	J=shor.shor(target,a=a,bits=main_register_bitnumber,verbose=False)
+	y = J.get_phase_distribution()	# Exact, so no shots or error bars are needed
+	fig,ax=plt.subplots()
+	ax.plot(phase_list,y,"o-")
+	ax.set_ylim([min(y)-0.2*min(y), max(y)+0.2*max(y)])
+	plt.xlabel("Output x/(2^L) of Shor's Algorithm")
+	plt.ylabel("Probability")
+	plt.title("""L={} bits, exact output distribution without errors""".format(main_register_bitnumber))
+	plt.show()
+
 if __name__=="__main__":
 	#test_factorising_success()
 	test_errorp()
@@ -0,0 +1,319 @@
+import numpy as np
+import random, itertools, os, math
+import functools, hashlib, json
+import multiprocessing
+import shared_arrays, results_store
+import work_queue
+
+def get_points(grid):
+	"""
+	Every combination of the parameter values in a grid, in order with the last parameter varying fastest.
+	grid = values of each parameter, such as {"error_size":[0.1,0.2],"errorp":[0,0.5,1]} (dict of lists)
+	"""
+	names = list(grid)
+	return [dict(zip(names,values)) for values in itertools.product(*[grid[name] for name in names])]
+
+def to_json(value):
+	"""
+	Converts values json cannot write itself, such as numpy scalars and functions, to a stable form.
+	"""
+	if isinstance(value,np.generic):
+		return value.item()
+	if isinstance(value,np.ndarray):
+		return value.tolist()
+	if callable(value):
+		return "{}.{}".format(value.__module__,value.__qualname__)	# The address in repr changes every run
+	return str(value)
+
+def get_config(shot_function,point,shots):
+	"""
+	Hash identifying the work done at one point of a sweep: the shot function, every parameter passed to it
+	(including those fixed with functools.partial) and the number of shots per trial.
+	"""
+	parameters = {}
+	if isinstance(shot_function,functools.partial):
+		parameters.update(shot_function.keywords)
+		shot_function = shot_function.func
+	parameters.update(point)
+	config = json.dumps({"function":shot_function,"parameters":parameters,"shots":shots},sort_keys=True,default=to_json)
+	return hashlib.sha256(config.encode("utf-8")).hexdigest()
+
+def read_log(filename):
+	"""
+	Reads the records of an append-only sweep log, one json object per line. A line left incomplete by
+	an interrupted write is ignored. Returns an empty list if the log does not exist yet.
+	"""
+	if not os.path.exists(filename):
+		return []
+	records = []
+	with open(filename) as file:
+		for line in file:
+			try:
+				records.append(json.loads(line))
+			except json.JSONDecodeError:
+				continue
+	return records
+
+def get_log_seed(log,shot_function,grid,shots):
+	"""
+	Seed of the last sweep of the same points logged by the current code version, which run_sweep
+	resumes when it is not given a seed. Returns None if there is none.
+	"""
+	configs = [get_config(shot_function,point,shots) for point in get_points(grid)]
+	code_version = results_store.get_code_version()
+	records = [record for record in read_log(log) if record.get("code_version") == code_version and record["config"] in configs]
+	return records[-1]["entropy"] if records else None
+
+def run_unit(unit):
+	"""
+	Runs the shots of one work unit, a single trial at a single parameter point, and returns its mean outcome.
+	Every shot draws from a generator built from the unit's own seed sequence, so every unit draws an
+	independent stream whichever worker process runs it. The global random and numpy.random states are
+	seeded from it too, for any code that does not take a generator.
+	unit = (shot_function, parameters, shots, seed sequence) (tuple)
+	"""
+	shot_function,point,shots,seed = unit
+	random.seed(int(seed.generate_state(1)[0]))
+	np.random.seed(seed.generate_state(4))
+	rng = np.random.default_rng(seed)
+	return np.mean(np.array([shot_function(**point,rng=rng) for i in range(shots)],dtype=float),axis=0)
+
+def run_indexed_unit(indexed):
+	index,unit = indexed
+	return (index,run_unit(unit))
+
+def get_pool(processes,published):
+	"""
+	Process pool whose workers attach the published shared arrays as they start.
+	"""
+	context = multiprocessing.get_context("spawn")	# Forked workers would share the parent's random state and GPU context
+	return context.Pool(processes,initializer=shared_arrays.attach,initargs=(published.handles,))
+
+def run_sweep(shot_function,grid,shots,trials,processes=None,chunk_size=None,seed=None,raw=None,log=None,cache=None,shared=None,progress=None,pool=None,queue=None,queue_timeout=None,verbose=None):
+	"""
+	Runs trials of shots at every point of a parameter grid across a pool of worker processes.
+	Returns (y, errors), the mean success over trials and its standard error, each as a numpy array
+	with one axis per grid parameter in the order given. Returns the success of every trial instead if raw is True.
+	shot_function = function taking the parameters of a point and a random number generator rng as keyword
+	    arguments and returning whether one shot succeeded, or an array of outcomes to average. It must be
+	    defined at module level so workers can import it (function)
+	grid = values of each parameter (dict of lists)
+	shots = number of shots in each trial (int)
+	trials = number of trials at each point (int)
+	processes = number of worker processes. Defaults to every core, 1 runs in this process (int)
+	chunk_size = number of work units handed to a worker at a time (int)
+	seed = seed of the sweep. Units draw the same streams for the same seed, however many processes are used (int)
+	raw = return the mean outcome of every trial, with the trials along the axis after the grid axes (bool)
+	log = json lines file every completed trial is appended to as it finishes. Trials already in the log with
+	    the same seed and code version are not run again, so an interrupted sweep picks up where it stopped
+	    when rerun. Without a seed, the seed of the last matching sweep in the log is resumed (str)
+	cache = cache the trials of each point are read from and saved to, so that only points with a new
+	    configuration are simulated. Only used when the seed is known, from the seed argument or a resumed log,
+	    as a seedless run should draw new random results every time (result_cache.ResultCache)
+	shared = named arrays published once into shared memory and attached by every worker without copying,
+	    where shot functions find them with shared_arrays.get (dict of numpy arrays)
+	progress = function called with (completed, total) work units as each unit finishes (function)
+	pool = running process pool or concurrent.futures executor to run the units on instead of starting one,
+	    so several sweeps can share the same workers. Shared arrays cannot be published to it (Pool or Executor)
+	queue = folder shared with work_queue workers on other machines, which run the units instead of a local pool.
+	    Shared arrays are not published to them, so shot functions compute their own operators (str)
+	queue_timeout = seconds after the last heartbeat of a queue worker that its units are re-issued (float)
+	"""
+	processes = processes if processes != None else os.cpu_count()
+	raw = raw if raw != None else False
+	verbose = verbose if verbose != None else True
+	points = get_points(grid)
+	configs = [get_config(shot_function,point,shots) for point in points]
+	code_version = results_store.get_code_version() if log != None else None
+	records = [record for record in read_log(log) if record.get("code_version") == code_version] if log != None else []
+	if seed is None and log != None:	# Resume with the streams of the interrupted sweep
+		seed = get_log_seed(log,shot_function,grid,shots)
+	if seed is None:
+		cache = None
+	sequence = np.random.SeedSequence(seed)
+	seeds = sequence.spawn(len(points)*trials)
+	completed = {(record["config"],record["trial"]):record["result"] for record in records if record["entropy"] == sequence.entropy}
+	cache_configs = [{"sweep_point":config,"trials":trials,"seed":seed} for config in configs]
+
+	results = [completed.get((configs[i],j)) for i in range(len(points)) for j in range(trials)]
+	if cache != None:
+		for i in range(len(points)):
+			arrays = cache.get(cache_configs[i])
+			if arrays != None:
+				results[i*trials:(i+1)*trials] = list(arrays["results"])
+	units = [(shot_function,points[i],shots,seeds[i*trials+j]) for i in range(len(points)) for j in range(trials)]
+	remaining = [(index,units[index]) for index in range(len(units)) if results[index] is None]
+	chunk_size = chunk_size if chunk_size != None else max(1,len(remaining)//(4*processes))
+	if verbose and len(remaining) < len(units): print("{}/{} work units already complete".format(len(units)-len(remaining),len(units)))
+
+	def collect(outputs):
+		file = open(log,"a") if log != None else None
+		if file != None and file.tell() > 0:
+			with open(log,"rb") as existing:
+				existing.seek(-1,os.SEEK_END)
+				if existing.read(1) != b"\n":
+					file.write("\n")	# Start after the partial line of an interrupted write
+		try:
+			for done,(index,success) in enumerate(outputs):
+				results[index] = success
+				if file != None:
+					i,j = divmod(index,trials)
+					record = {"config":configs[i],"point":points[i],"trial":j,"shots":shots,"result":success,"entropy":sequence.entropy,"code_version":code_version}
+					file.write(json.dumps(record,default=to_json)+"\n")
+					file.flush()
+					os.fsync(file.fileno())	# The record survives a crash as soon as it is written
+				if progress != None: progress(done+1,len(remaining))
+				if verbose: print("Completed {}/{} work units of {} shots".format(done+1,len(remaining),shots),end="\r",flush=True)
+		finally:
+			if file != None:
+				file.close()
+	if pool != None and shared:
+		raise ValueError("Shared arrays can only be published to a pool started by run_sweep")
+	if len(remaining) == 0 or (pool is None and queue is None and processes == 1):
+		shared_arrays.attached.update(shared if shared != None else {})
+		try:
+			collect(map(run_indexed_unit,remaining))
+		finally:
+			for name in (shared if shared != None else {}):
+				shared_arrays.attached.pop(name,None)
+	elif queue != None:
+		indices = [index for index,unit in remaining]
+		coordinator = work_queue.Coordinator(queue)
+		coordinator.submit(shot_function,grid,shots,trials,seed=sequence.entropy,indices=indices)
+		if verbose: print("Queued {} work units in {}".format(len(indices),queue))
+		collect(coordinator.collect(indices,timeout=queue_timeout,verbose=verbose))
+	elif pool != None:
+		if hasattr(pool,"imap_unordered"):
+			collect(pool.imap_unordered(run_indexed_unit,remaining,chunksize=chunk_size))
+		else:
+			collect(pool.map(run_indexed_unit,remaining,chunksize=chunk_size))
+	else:
+		with shared_arrays.SharedArrays(shared if shared != None else {}) as published, get_pool(processes,published) as pool:
+			collect(pool.imap_unordered(run_indexed_unit,remaining,chunksize=chunk_size))
+	if verbose: print("\nDone!")
+	if cache != None:
+		for i in sorted({index//trials for index,unit in remaining}):
+			cache.put(cache_configs[i],{"results":np.array(results[i*trials:(i+1)*trials],dtype=float)})
+
+	shape = tuple(len(values) for values in grid.values())
+	results = np.array(results)
+	results = results.reshape(shape+(trials,)+results.shape[1:])
+	if raw:
+		return results
+	axis = len(shape)
+	return (np.mean(results,axis=axis),np.std(results,axis=axis)/np.sqrt(trials))
+
+def wilson_interval(successes,shots,z=None):
+	"""
+	Wilson score interval on a success probability. Returns (lower, upper).
+	z = number of standard errors spanned by the interval. Defaults to 1.96 (float)
+	"""
+	z = z if z != None else 1.96
+	if shots == 0:
+		return (0.0,1.0)
+	p = successes/shots
+	centre = (p+z**2/(2*shots))/(1+z**2/shots)
+	halfwidth = z/(1+z**2/shots)*np.sqrt(p*(1-p)/shots+z**2/(4*shots**2))
+	return (float(max(centre-halfwidth,0)),float(min(centre+halfwidth,1)))
+
+def clopper_pearson_interval(successes,shots,z=None):
+	"""
+	Exact Clopper-Pearson interval on a success probability, found by bisection on the binomial
+	distribution function so that scipy is not needed. Returns (lower, upper).
+	z = the interval has the same coverage as a normal interval of z standard errors. Defaults to 1.96 (float)
+	"""
+	z = z if z != None else 1.96
+	if shots == 0:
+		return (0.0,1.0)
+	alpha = math.erfc(z/np.sqrt(2))	# Two-sided tail probability
+	k = np.arange(shots+1)
+	log_comb = np.array([math.lgamma(shots+1)-math.lgamma(i+1)-math.lgamma(shots-i+1) for i in k])
+	def tail(p,start):	# P(X >= start) for X ~ Binomial(shots, p)
+		if p <= 0:
+			return float(start <= 0)
+		if p >= 1:
+			return 1.0
+		log_pmf = log_comb[start:]+k[start:]*np.log(p)+(shots-k[start:])*np.log1p(-p)
+		return float(np.exp(np.logaddexp.reduce(log_pmf))) if len(log_pmf) > 0 else 0.0
+	def solve(f,target):	# f increases with p
+		low,high = 0.0,1.0
+		for i in range(60):
+			middle = (low+high)/2
+			low,high = (middle,high) if f(middle) < target else (low,middle)
+		return (low+high)/2
+	lower = solve(lambda p: tail(p,successes),alpha/2) if successes > 0 else 0.0
+	upper = solve(lambda p: tail(p,successes+1),1-alpha/2) if successes < shots else 1.0
+	return (lower,upper)
+
+INTERVALS = {"wilson":wilson_interval,"clopper-pearson":clopper_pearson_interval}
+
+def run_adaptive_sweep(shot_function,grid,width,batch=None,max_shots=None,interval=None,z=None,processes=None,seed=None,shared=None,verbose=None):
+	"""
+	Runs shots at every point of a parameter grid until the confidence interval on the success probability
+	of each point is narrower than width, or until its budget of shots runs out. Each round gives every
+	unfinished point the number of shots its current estimate predicts it still needs, up to doubling its
+	shots, so points near a success probability of 0.5 get the most shots and points near 0 or 1 finish early.
+	Returns (y, lower, upper, shots used), each a numpy array with one axis per grid parameter.
+	shot_function = function taking the parameters of a point and a random number generator rng as keyword
+	    arguments and returning whether one shot succeeded. It must be defined at module level so workers
+	    can import it (function)
+	grid = values of each parameter (dict of lists)
+	width = target width of the confidence interval of every point (float)
+	batch = number of shots in each work unit, and the fewest shots added to a point in a round (int)
+	max_shots = budget of shots at each point (int)
+	interval = "wilson" or "clopper-pearson" (str)
+	z = number of standard errors spanned by the interval. Defaults to 1.96 (float)
+	shared = named arrays published to every worker, see run_sweep (dict of numpy arrays)
+	"""
+	batch = batch if batch != None else 50
+	max_shots = max_shots if max_shots != None else 10000
+	interval = interval if interval != None else "wilson"
+	z = z if z != None else 1.96
+	processes = processes if processes != None else os.cpu_count()
+	verbose = verbose if verbose != None else True
+	if interval not in INTERVALS:
+		raise ValueError("Unknown interval: {}".format(interval))
+	points = get_points(grid)
+	sequences = np.random.SeedSequence(seed).spawn(len(points))	# Each point spawns its units' seeds in order
+	successes = np.zeros(len(points),dtype=int)
+	shots = np.zeros(len(points),dtype=int)
+	bounds = [(0.0,1.0) for point in points]
+
+	published = shared_arrays.SharedArrays(shared if shared != None else {}) if processes != 1 else None
+	pool = get_pool(processes,published) if processes != 1 else None
+	if processes == 1:
+		shared_arrays.attached.update(shared if shared != None else {})
+	try:
+		while True:
+			units = []
+			for i in range(len(points)):
+				if bounds[i][1]-bounds[i][0] <= width or shots[i] >= max_shots:
+					continue
+				p = min(max((successes[i]+1)/(shots[i]+2),0.05),0.95)	# Smoothed, so a run of identical outcomes still gets more shots
+				needed = int(np.ceil(4*z**2*p*(1-p)/width**2))-shots[i]
+				# A pilot batch first, then at most double the shots per round so a poor early estimate cannot overspend
+				allocation = min(max(needed,batch),max(shots[i],batch),max_shots-shots[i])
+				for size in [batch]*(allocation//batch)+([allocation%batch] if allocation%batch else []):
+					units.append((i,(shot_function,points[i],size,sequences[i].spawn(1)[0])))
+			if len(units) == 0:
+				break
+			indexed = [(n,unit) for n,(i,unit) in enumerate(units)]
+			outputs = pool.imap_unordered(run_indexed_unit,indexed) if pool != None else map(run_indexed_unit,indexed)
+			for n,mean in outputs:
+				i,unit = units[n]
+				successes[i] += int(round(mean*unit[2]))
+				shots[i] += unit[2]
+			bounds = [INTERVALS[interval](successes[i],shots[i],z=z) for i in range(len(points))]
+			if verbose: print("Simulated {} shots, {}/{} points finished".format(np.sum(shots),sum(upper-lower <= width or shots[i] >= max_shots for i,(lower,upper) in enumerate(bounds)),len(points)),end="\r",flush=True)
+	finally:
+		if pool != None:
+			pool.terminate()
+			pool.join()
+			published.close()
+		for name in (shared if shared != None and processes == 1 else {}):
+			shared_arrays.attached.pop(name,None)
+	if verbose: print("\nDone!")
+
+	shape = tuple(len(values) for values in grid.values())
+	lower,upper = np.array(bounds).T
+	return ((successes/shots).reshape(shape),lower.reshape(shape),upper.reshape(shape),shots.reshape(shape))
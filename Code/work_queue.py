@@ -0,0 +1,310 @@
+import numpy as np
+import glob, json, os, pickle, socket, sys, threading, time, traceback, warnings
+import sweep
+import results_store
+
+def write_atomic(path,text):
+	"""
+	Writes a file under a temporary name and renames it into place, so readers never see it half written.
+	"""
+	temporary = "{}.{}.{}.tmp".format(path,socket.gethostname(),os.getpid())
+	with open(temporary,"w") as file:
+		file.write(text)
+		file.flush()
+		os.fsync(file.fileno())
+	os.replace(temporary,path)
+
+def get_worker_name():
+	return "{}-{}".format(socket.gethostname(),os.getpid())
+
+def get_index(path):
+	return int(os.path.basename(path).split(".")[0])
+
+class Coordinator:
+
+	def __init__(self,folder):
+		"""
+		Hands out the work units of a sweep through a shared folder and merges the results that workers
+		write back. Start workers on any machine that can see the folder with
+		    python work_queue.py worker <folder>
+		Units wait in pending/ as pickled files. A worker claims one by renaming it into claimed/ with its own name
+		appended, which only one worker can do, and writes the result to done/ when it finishes, or the error to
+		failed/ if the unit raised one. Workers touch a file
+		in workers/ every few seconds, and reissue returns the claims of workers that have stopped to pending/.
+		Every unit keeps its own seed, so a unit run twice after being re-issued gives the same result both times.
+		folder = queue folder, on a filesystem shared with the workers (str)
+		"""
+		self.folder = folder
+		for name in ("pending","claimed","done","failed","workers"):
+			os.makedirs(os.path.join(folder,name),exist_ok=True)
+
+	def submit(self,shot_function,grid,shots,trials,seed=None,indices=None,clear=None):
+		"""
+		Splits a sweep into one work unit per trial at each point of the grid and queues them. Arguments as
+		for sweep.run_sweep. The shot function must be importable by the workers, so defined at module level,
+		optionally with parameters fixed by functools.partial. Submitting the same sweep to a folder again
+		only queues the units that are neither done nor claimed, including any that failed.
+		A folder holding a different sweep is refused.
+		indices = units to queue, numbered by point and then trial as in sweep.run_sweep. Defaults to every unit (list)
+		clear = remove the units and results of a different sweep held by the folder instead of refusing (bool)
+		"""
+		clear = clear if clear != None else False
+		existing = self.get_description() if os.path.exists(os.path.join(self.folder,"sweep.json")) else None
+		if seed is None and existing != None:	# Resume with the streams of the submitted sweep
+			seed = existing["entropy"]
+		points = sweep.get_points(grid)
+		sequence = np.random.SeedSequence(seed)
+		seeds = sequence.spawn(len(points)*trials)
+		description = json.loads(json.dumps({"grid":grid,"shots":shots,"trials":trials,"entropy":sequence.entropy,
+			"configs":[sweep.get_config(shot_function,point,shots) for point in points]},default=sweep.to_json))
+		if existing != None and any(existing[key] != description[key] for key in ("configs","shots","trials","entropy")):
+			if not clear:
+				raise ValueError("{} holds a different sweep. Use another folder, or submit with clear=True to replace it".format(self.folder))
+			for name in ("pending","claimed","done","failed"):
+				for path in self.get_files(name):
+					os.remove(path)
+		write_atomic(os.path.join(self.folder,"sweep.json"),json.dumps(description))
+		started = set(self.get_done(description))|{get_index(path) for path in self.get_files("claimed")}
+		indices = indices if indices != None else range(len(points)*trials)
+		for index in indices:
+			if index in started:
+				continue
+			unit = (shot_function,points[index//trials],shots,seeds[index])
+			temporary = os.path.join(self.folder,"{}.tmp".format(index))
+			with open(temporary,"wb") as file:
+				pickle.dump(unit,file)
+			os.replace(temporary,os.path.join(self.folder,"pending","{}.pkl".format(index)))
+			try:
+				os.remove(os.path.join(self.folder,"failed","{}.json".format(index)))	# Run it again
+			except FileNotFoundError:
+				pass
+
+	def get_description(self):
+		"""
+		Returns the grid, shots, trials, entropy and point configurations of the submitted sweep.
+		"""
+		with open(os.path.join(self.folder,"sweep.json")) as file:
+			return json.load(file)
+
+	def get_done(self,description=None,name=None):
+		"""
+		Returns the records of the finished units of the submitted sweep by index. Results that a worker
+		still running a unit of an earlier sweep wrote after the folder was cleared are left out.
+		name = "done" for results, or "failed" for the errors of units that raised one (str)
+		"""
+		description = description if description != None else self.get_description()
+		name = name if name != None else "done"
+		records = {}
+		for path in self.get_files(name):
+			with open(path) as file:
+				record = json.load(file)
+			if record["index"] >= len(description["configs"])*description["trials"]:
+				continue
+			if record.get("config") is None and name == "failed":	# The unit could not even be loaded
+				records[record["index"]] = record
+			elif record.get("config") == description["configs"][record["index"]//description["trials"]] and record.get("entropy") == description["entropy"]:
+				records[record["index"]] = record
+		return records
+
+	def failures(self):
+		"""
+		Returns the error of every unit of the submitted sweep that failed, by index.
+		"""
+		return {index:record["error"] for index,record in self.get_done(name="failed").items()}
+
+	def get_files(self,name):
+		return [path for path in glob.glob(os.path.join(self.folder,name,"*")) if not path.endswith(".tmp")]
+
+	def get_time(self):
+		"""
+		Current time on the shared filesystem, so that heartbeats are compared without trusting the clocks of the machines to agree.
+		"""
+		path = os.path.join(self.folder,"workers",".now")
+		with open(path,"w"):
+			pass
+		return os.path.getmtime(path)
+
+	def reissue(self,timeout=None):
+		"""
+		Returns the units claimed by workers that have not sent a heartbeat for timeout seconds to pending/.
+		Returns the number of units re-issued.
+		timeout = seconds after the last heartbeat that a worker is taken to be lost (float)
+		"""
+		timeout = timeout if timeout != None else 60
+		now = self.get_time()
+		reissued = 0
+		for claim in self.get_files("claimed"):
+			worker = os.path.basename(claim).split(".",2)[2]
+			heartbeat = os.path.join(self.folder,"workers",worker)
+			try:
+				alive = now-os.path.getmtime(heartbeat) < timeout
+			except FileNotFoundError:	# The worker claimed the unit but never sent a heartbeat
+				alive = now-os.path.getmtime(claim) < timeout
+			if not alive:
+				index = get_index(claim)
+				try:
+					os.rename(claim,os.path.join(self.folder,"pending","{}.pkl".format(index)))
+					reissued += 1
+				except FileNotFoundError:	# Finished meanwhile
+					continue
+		return reissued
+
+	def progress(self):
+		"""
+		Returns the number of units done and the total number of units.
+		"""
+		description = self.get_description()
+		return (len(self.get_done(description)),len(description["configs"])*description["trials"])
+
+	def merge(self,output=None):
+		"""
+		Merges the results written so far and returns (y, errors) shaped like the grid, as sweep.run_sweep does.
+		Units that are not done yet or failed are left out of the means, which are nan at points with no finished trial.
+		Saves the raw results, the means and their errors to output with results_store when given.
+		output = folder to save the merged results to (str)
+		"""
+		description = self.get_description()
+		grid,trials = description["grid"],description["trials"]
+		total = len(description["configs"])*trials
+		results = [None]*total
+		workers = {}
+		for record in self.get_done(description).values():
+			results[record["index"]] = np.asarray(record["result"],dtype=float)
+			workers[record["worker"]] = workers.get(record["worker"],0)+1
+		finished = [result for result in results if result is not None]
+		blank = np.full_like(finished[0],np.nan) if finished else np.nan
+		results = np.array([result if result is not None else blank for result in results])
+		shape = tuple(len(values) for values in grid.values())
+		results = results.reshape(shape+(trials,)+results.shape[1:])
+		axis = len(shape)
+		counts = np.sum(~np.isnan(results),axis=axis)
+		with warnings.catch_warnings():	# Points with no finished trial are nan
+			warnings.simplefilter("ignore",RuntimeWarning)
+			y = np.nanmean(results,axis=axis) if finished else np.mean(results,axis=axis)
+			errors = np.sqrt(np.nanmean((results-np.expand_dims(y,axis))**2,axis=axis)/counts) if finished else y
+		if output != None:
+			metadata = {"grid":grid,"shots":description["shots"],"trials":trials,"entropy":description["entropy"],
+				"units_done":len(finished),"units":total,"complete":len(finished) == total,"workers":workers,
+				"units_failed":{index:error.strip().splitlines()[-1] for index,error in self.failures().items()}}
+			results_store.save_results(output,{"results":results,"y":y,"errors":errors},metadata=metadata)
+		return (y,errors)
+
+	def collect(self,indices=None,timeout=None,poll=None,verbose=None):
+		"""
+		Yields (index, result) for each unit as workers finish it, re-issuing the units of lost workers while
+		waiting. Raises RuntimeError with the errors of the failed units once only failed units are left.
+		indices = units to wait for. Defaults to every unit of the sweep (list)
+		timeout = seconds after the last heartbeat that a worker is taken to be lost (float)
+		poll = seconds between checks (float)
+		"""
+		poll = poll if poll != None else 5
+		verbose = verbose if verbose != None else False
+		description = self.get_description()
+		waiting = set(indices if indices != None else range(len(description["configs"])*description["trials"]))
+		while waiting:
+			done = self.get_done(description)
+			for index in sorted(waiting & set(done)):
+				waiting.remove(index)
+				yield (index,np.asarray(done[index]["result"],dtype=float))
+			failed = {index:record["error"] for index,record in self.get_done(description,name="failed").items() if index in waiting}
+			if waiting and set(failed) == waiting:
+				raise RuntimeError("{} work units failed, the first with:\n{}".format(len(failed),failed[min(failed)]))
+			if waiting:
+				reissued = self.reissue(timeout)
+				if verbose and reissued: print("\nRe-issued {} work units of lost workers".format(reissued))
+				time.sleep(poll)
+
+	def wait(self,output=None,timeout=None,poll=None,verbose=None):
+		"""
+		Re-issues lost units until every unit is done, then merges the results. See merge and collect.
+		If units failed, the other results are merged and saved before the RuntimeError is raised.
+		timeout = seconds after the last heartbeat that a worker is taken to be lost (float)
+		poll = seconds between checks (float)
+		"""
+		verbose = verbose if verbose != None else True
+		done,total = self.progress()
+		try:
+			for index,result in self.collect([index for index in range(total) if index not in self.get_done()],timeout=timeout,poll=poll,verbose=verbose):
+				done += 1
+				if verbose: print("Completed {}/{} work units".format(done,total),end="\r",flush=True)
+		except RuntimeError:
+			self.merge(output)
+			raise
+		if verbose: print("\nDone!")
+		return self.merge(output)
+
+def heartbeat(path,interval,stop):
+	while not stop.wait(interval):
+		with open(path,"a"):
+			os.utime(path)
+
+def run_worker(folder,name=None,interval=None,idle=None,verbose=None):
+	"""
+	Claims and runs work units from a queue folder until none have been pending for idle seconds.
+	A unit that raises an error is recorded in failed/ and not run again until it is submitted again.
+	Returns the number of units run.
+	folder = queue folder of a Coordinator (str)
+	name = name of this worker, unique across machines. Defaults to the host name and process id (str)
+	interval = seconds between heartbeats (float)
+	idle = seconds to wait for new units before stopping. Defaults to stopping as soon as none are pending (float)
+	"""
+	name = name if name != None else get_worker_name()
+	interval = interval if interval != None else 5
+	idle = idle if idle != None else 0
+	verbose = verbose if verbose != None else True
+	beat = os.path.join(folder,"workers",name)
+	with open(beat,"a"):
+		os.utime(beat)
+	stop = threading.Event()
+	threading.Thread(target=heartbeat,args=(beat,interval,stop),daemon=True).start()
+	count = 0
+	waited = 0
+	try:
+		while True:
+			pending = sorted(glob.glob(os.path.join(folder,"pending","*.pkl")),key=get_index)
+			if not pending:
+				if waited >= idle:
+					break
+				time.sleep(min(interval,idle))
+				waited += min(interval,idle)
+				continue
+			waited = 0
+			for path in pending:
+				index = get_index(path)
+				claim = os.path.join(folder,"claimed","{}.pkl.{}".format(index,name))
+				try:
+					os.rename(path,claim)
+				except FileNotFoundError:	# Claimed by another worker first
+					continue
+				record = {"index":index,"worker":name,"config":None,"entropy":None}
+				try:
+					with open(claim,"rb") as file:
+						unit = pickle.load(file)
+					shot_function,point,shots,seed = unit
+					record.update(config=sweep.get_config(shot_function,point,shots),entropy=seed.entropy)
+					record["result"] = sweep.run_unit(unit)
+					outcome = "done"
+				except Exception:	# Recorded for the coordinator, rather than re-issued to crash the next worker
+					record["error"] = traceback.format_exc()
+					outcome = "failed"
+				write_atomic(os.path.join(folder,outcome,"{}.json".format(index)),json.dumps(record,default=sweep.to_json))
+				try:
+					os.remove(claim)
+				except FileNotFoundError:	# Re-issued while running, and the other copy gives the same result
+					pass
+				count += 1
+				if verbose: print("{} work unit {}".format("Completed" if outcome == "done" else "Failed",index),flush=True)
+				break	# Look again, in case units were re-issued
+	finally:
+		stop.set()
+	return count
+
+def main():
+	if len(sys.argv) < 3 or sys.argv[1] != "worker":
+		print("Usage: python work_queue.py worker <folder> [idle seconds]")
+		print("Sweeps are submitted to a folder with sweep.run_sweep(...,queue=<folder>)")
+		return
+	run_worker(sys.argv[2],idle=float(sys.argv[3]) if len(sys.argv) > 3 else None)
+
+if __name__=="__main__":
+	main()